@@ -1,9 +1,12 @@
-from .parsers import parse_sam, parse_broadpeak, parse_narrowpeak,\
-                    load_hic_Rao, parse_hic, res_string, parse_kallisto_rnaseq,\
-                    chromosome_size, bam_to_matrix, parse_simple_bed,\
+from .parsers import parse_sam, iter_sam, sam_references, parse_broadpeak,\
+                    parse_narrowpeak, load_hic_Rao, parse_hic, res_string,\
+                    parse_kallisto_rnaseq, chromosome_size, bam_to_matrix,\
+                    bam_to_sparse_matrix, bam_to_matrices, parse_simple_bed,\
                     counts_to_hic
+from .parsercache import enable_parser_cache, disable_parser_cache,\
+                         clear_parser_cache
 from .utils import error_message, log_message, warn_message, consecutive_true,\
-                   mkdir_p, map_seq_to_int, map_int_to_seq
+                   mkdir_p, map_seq_to_int, map_int_to_seq, parallel_map
 try :
     from .vistools import myboxplot, plot_hic_matrix, line_plot, ax_only_y,\
                           color_density_scatter, plot_triangular_matrix, sequence_logo
@@ -11,15 +14,31 @@ except RuntimeError :
     pass
 from .hoomdsims import *
 from .nettools import *
-from .cellline import CellLine, Region, region_chipseq, region_hic
+from .hicmatrix import HiCMatrix
+from .peakindex import PeakIndex
+from .hicstore import HiCPyramid, build_hic_pyramid, GenomeContactMatrix,\
+                      build_genome_matrix
+from .genome import Genome, get_genome, register_genome
+from .coverage import bam_coverage, CoverageTrack
+from .tracks import LazyTrack, TrackCache, TrackCatalog, match_condition
+from .cellline import CellLine, Region, RegionSet, region_chipseq, region_hic
 from .beatolabtools import load_beato_metadata, load_hic_metadata, \
-                           cell_load_tracks, cell_load_hic, load_rnaseq,\
-                           track_location, hic_location, hic_bam_location,\
-                           bw_location, chipseq_bam_location, ChIPseq
+                           read_metadata, select_metadata,\
+                           cell_load_tracks, cell_load_hic, cell_bulk_load,\
+                           load_rnaseq, rnaseq_location, load_rnaseq_matrix,\
+                           track_location, hic_location,\
+                           hic_bam_location, bw_location, chipseq_bam_location,\
+                           chipseq_peaks_location, set_location_index,\
+                           ChIPseq, count_peaks
+from .locationindex import LocationIndex
+from .expression import ExpressionMatrix
 from .moremath import autocorrelation, linear_fit, linear_regression,\
                       wlinear_fit, KL_divergence, LJ_potential, new_average, \
                       fit_powerlaw
 from .random_walk_diffusion import random_spin3d, random_walk_3D
 from .mc import metropolis
-from .hic_tools import counts_hic
-from .zerone_utils import parse_zerone_output, find_zerone_peak
+from .hic_tools import counts_hic, ice_balance, kr_balance, apply_bias,\
+                       diagonal_sums, expected_contacts, oe_block,\
+                       iter_oe_blocks, ExpectedContacts
+from .zerone_utils import parse_zerone_output, find_zerone_peak,\
+                          find_zerone_peaks
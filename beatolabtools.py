@@ -2,176 +2,416 @@ import numpy as np
 import pandas as pd
 import pysam
 import os
-from .utils import log_message, warn_message
+import time
+import functools
+import weakref
+from .utils import log_message, warn_message, error_message, parallel_map,\
+                   chromosome_key
+from .parsercache import cached_object
+from .coverage import bam_coverage, CoverageTrack
+from .expression import ExpressionMatrix
 from .parsers import res_string, parse_kallisto_rnaseq, parse_simple_bed,\
                       parse_narrowpeak
 
+# the columns of the metadata spreadsheets that are indexed when loaded
+METADATA_INDEX_COLUMNS = ('SAMPLE_ID',)
+# id(table) -> (weak reference to the table, {column : {value : rows}})
+_metadata_indexes = {}
+
+def _index_columns (df,columns) :
+    """
+    Returns, for each of the 'columns' of 'df', the dictionary that maps each
+    value of the column to the positions of the rows that have it.
+    """
+    indexes = {}
+    for column in columns :
+        if column in df.columns :
+            groups = df.groupby(column,sort=False).indices
+            indexes[column] = dict((k,np.asarray(v)) for k,v in groups.items())
+    return indexes
+
+def _register_indexes (df,indexes) :
+    for key in [k for k,(ref,ix) in _metadata_indexes.items() if ref() is None] :
+        del _metadata_indexes[key]
+    entry = _metadata_indexes.get(id(df))
+    if entry is not None and entry[0]() is df :
+        entry[1].update(indexes)
+    else :
+        _metadata_indexes[id(df)] = (weakref.ref(df),indexes)
+
+def _read_indexed_metadata (fname,index_columns) :
+    df = pd.read_excel(fname)
+    return df,_index_columns(df,index_columns)
+
+def read_metadata (fname,cache=True,index_columns=METADATA_INDEX_COLUMNS) :
+    """
+    Reads the metadata spreadsheet 'fname', and indexes its 'index_columns'
+    (see 'select_metadata'). If 'cache' is True and the parser cache is
+    enabled (see 'enable_parser_cache'), the table and its indexes are stored
+    in the cache, and read in place of the spreadsheet until the latter
+    changes.
+    """
+    read = lambda : _read_indexed_metadata(fname,index_columns)
+    if cache :
+        tag = 'read_metadata:%r'%(tuple(index_columns),)
+        df,indexes = cached_object(fname,tag,read)
+    else :
+        df,indexes = read()
+    _register_indexes(df,indexes)
+    return df
+
+def select_metadata (metadata,values,column='SAMPLE_ID') :
+    """
+    Returns the rows of the 'metadata' table whose 'column' has one of the
+    'values', in the order of the values. The index of the column that was
+    built when the table was loaded is used, or built on the first call. The
+    index reflects the table as it was loaded: it is not updated if the table
+    is modified in place.
+    """
+    if isinstance(values,str) or np.isscalar(values) :
+        values = [values]
+    entry = _metadata_indexes.get(id(metadata))
+    if entry is None or entry[0]() is not metadata or column not in entry[1] :
+        _register_indexes(metadata,_index_columns(metadata,[column]))
+        entry = _metadata_indexes[id(metadata)]
+    index = entry[1][column]
+    empty = np.array([],dtype=np.int64)
+    rows = [index.get(v,empty) for v in values]
+    return metadata.iloc[np.concatenate(rows) if rows else empty]
+
 def load_beato_metadata (
-    metadata_file='/home/rcortini/work/data/beato_lab_metadata.xlsx') :
-    return pd.read_excel(metadata_file)
+    metadata_file='/home/rcortini/work/data/beato_lab_metadata.xlsx',
+    cache=True) :
+    return read_metadata(metadata_file,cache)
 
 def load_hic_metadata (
-    hic_metadata_file='/home/rcortini/work/data/beato_lab_hic_metadata.xlsx') :
-    return pd.read_excel(hic_metadata_file)
-
-def track_location (typ,sample_id,xavi_datadir='/mnt/xavi/data') :
-    # build the directory name where the files are
-    d = "%s/%s/samples/%s/peaks"%(xavi_datadir,
-                                  typ,
-                                  sample_id)
-    # select all files that end with ".narrowPeak" in the directory, and
-    # then prefer to read the one that is in the directory that has
-    # "with_control"
-    peakfiles = []
+    hic_metadata_file='/home/rcortini/work/data/beato_lab_hic_metadata.xlsx',
+    cache=True) :
+    return read_metadata(hic_metadata_file,cache)
+
+# the LocationIndex used by the '*_location' functions, see 'set_location_index'
+_location_index = {'index' : None}
+
+def set_location_index (index) :
+    """
+    Makes the '*_location' functions look the files up in the LocationIndex
+    'index' instead of walking the directories, for the data roots that the
+    index covers. Pass None to go back to walking the directories.
+    """
+    _location_index['index'] = index
+
+def sample_files (base,sample_id,section,suffix,index=None) :
+    """
+    Returns the paths of the files whose name ends with 'suffix' in the
+    directory '<base>/samples/<sample_id>/<section>' and its subdirectories
+    (the whole sample directory if 'section' is empty). The files are looked
+    up in the LocationIndex 'index' (by default, the one given to
+    'set_location_index') if it covers 'base', or found with os.walk.
+    """
+    if index is None :
+        index = _location_index['index']
+    if index is not None and index.covers(base) :
+        return [r['path'] for r in index.files(base,sample_id,section or None)
+                if r['name'].endswith(suffix)]
+    d = "%s/samples/%s"%(base,sample_id)
+    if section :
+        d = "%s/%s"%(d,section)
+    paths = []
     for root,sub,files in os.walk(d) :
         for f in files :
-            if f.endswith (".narrowPeak") :
-                peakfiles.append('%s/%s'%(root,f))
+            if f.endswith (suffix) :
+                paths.append('%s/%s'%(root,f))
+    return paths
+
+def prefer_with_control (paths) :
+    """
+    Returns the first of the 'paths' that is in a "with_control" directory,
+    or else the last one, or None if there are no paths.
+    """
     fin = None
-    for peakfile in peakfiles :
-        if 'with_control' in peakfile :
-            fin = peakfile
-            break
-        else :
-            fin = peakfile
+    for path in paths :
+        if 'with_control' in path :
+            return path
+        fin = path
+    return fin
+
+def track_location (typ,sample_id,xavi_datadir='/mnt/xavi/data',index=None) :
+    # select all files that end with ".narrowPeak" in the directory, and
+    # then prefer to read the one that is in the directory that has
+    # "with_control"
+    peakfiles = sample_files('%s/%s'%(xavi_datadir,typ),sample_id,'peaks',
+                             '.narrowPeak',index)
+    fin = prefer_with_control(peakfiles)
     if fin is None :
         warn_message('cell_load_tracks','Data not found for %s'%sample_id)
     return fin
 
-def cell_load_tracks (cell,tracks,resolution=10000,xavi_datadir='/mnt/xavi/data') :
+def _locate_and_parse (job) :
+    """
+    Worker of 'cell_bulk_load': resolves the location of a file with the
+    'locate' function and parses it with 'parser', if given. Returns the
+    file name, the parsed data, the elapsed time and the error, if any (a
+    file that is not found is an error).
+    """
+    n,locate,parser = job
+    t0 = time.time()
+    fname,data,error = None,None,None
+    try :
+        fname = locate()
+        if fname is None :
+            raise IOError ("Data not found")
+        if parser is not None :
+            data = parser(fname)
+    except Exception as e :
+        error = '%s: %s'%(type(e).__name__,e)
+    return n,fname,data,time.time()-t0,error
+
+def cell_bulk_load (cell,jobs,processes=1,threads=True) :
+    """
+    Loads the tracks described by 'jobs' into the CellLine 'cell'. Each job
+    is a (metadata, locate) tuple, where 'locate' is a function that returns
+    the file name of the track (or None, if not found). Unless 'processes' is
+    1, the file locations are resolved and the files are parsed concurrently
+    by a pool of 'processes' workers (one per CPU if None), that are threads
+    if 'threads' is True and processes otherwise. The tracks are added to the
+    CellLine in the order of 'jobs'. Returns a DataFrame with the file name,
+    the time spent locating and parsing the file, and the error (if any) of
+    each job.
+    """
+    tasks = []
+    for n,(metadata,locate) in enumerate(jobs) :
+        parser = None if cell.lazy else cell.parsers.get(metadata['type'])
+        tasks.append((n,locate,parser))
+    report = []
+    for n,fname,data,elapsed,error in parallel_map(_locate_and_parse,tasks,
+                                                   processes,threads) :
+        metadata = jobs[n][0]
+        if error is None :
+            metadata['fname'] = fname
+            try :
+                t0 = time.time()
+                cell.load_track(metadata,data=data)
+                elapsed += time.time()-t0
+            except (KeyError,IOError) as e :
+                error = '%s: %s'%(type(e).__name__,e)
+        if error is not None :
+            error_message('cell_bulk_load','Failed to load %s: %s'%
+                          (metadata.get('SAMPLE_ID'),error))
+        report.append({'SAMPLE_ID' : metadata.get('SAMPLE_ID'),
+                       'fname'     : fname,
+                       'time'      : elapsed,
+                       'error'     : error})
+    return pd.DataFrame(report,columns=['SAMPLE_ID','fname','time','error'])
+
+def cell_load_tracks (cell,tracks,resolution=10000,xavi_datadir='/mnt/xavi/data',
+                      processes=1,threads=True) :
+    """
+    Loads the ChIP-seq tracks of the samples in the 'tracks' DataFrame into
+    the CellLine 'cell'. See 'cell_bulk_load' for the parallel loading
+    options and the returned report.
+    """
+    jobs = []
     for i,track in tracks.iterrows() :
         metadata = track.to_dict()
         sample_id = track['SAMPLE_ID']
         metadata['type'] = sample_id.split('_')[-1]
         metadata['resolution'] = resolution
-        fin = track_location(metadata['type'],sample_id)
-        if fin is not None :
-            metadata['fname'] = fin
-            cell.load_track(metadata)
+        locate = functools.partial(track_location,metadata['type'],sample_id,
+                                   xavi_datadir)
+        jobs.append((metadata,locate))
+    return cell_bulk_load(cell,jobs,processes,threads)
 
-def hic_location(sample_id,resolution,datatype_string='raw',xavi_hic_datadir='/mnt/hic') :
-    d = "%s/samples/%s/downstream"%(xavi_hic_datadir,sample_id)
-    fname = None
+def hic_location(sample_id,resolution,datatype_string='raw',xavi_hic_datadir='/mnt/hic',
+                index=None) :
     res = res_string (resolution)
-    if os.path.exists(d) :
-        for root,subdirs,files in os.walk(d) :
-            for f in files :
-                if datatype_string in f and f.endswith ('%s.tsv.gz'%res) :
-                    fname = '%s/%s'%(root,f)
+    fname = None
+    for path in sample_files(xavi_hic_datadir,sample_id,'downstream',
+                             '%s.tsv.gz'%res,index) :
+        if datatype_string in os.path.basename(path) :
+            fname = path
     if fname is None :
         warn_message('cell_load_hic','Data not found for %s'%sample_id)
     return fname
 
 def cell_load_hic (cell,tracks,resolution,
                    datatype_string='raw',
-                   xavi_hic_datadir='/mnt/hic') :
+                   xavi_hic_datadir='/mnt/hic',
+                   processes=1,threads=True) :
+    """
+    Loads the Hi-C tracks of the samples in the 'tracks' DataFrame into the
+    CellLine 'cell'. See 'cell_bulk_load' for the parallel loading options
+    and the returned report.
+    """
+    jobs = []
     for i,track in tracks.iterrows() :
         metadata = track.to_dict()
         sample_id = track['SAMPLE_ID']
         metadata['type'] = 'hic'
         metadata['resolution'] = resolution
-        metadata['fname'] = hic_location (sample_id,resolution)
-        if metadata['fname'] is not None :
-            log_message('cell_load_hic','Loading %s'%(sample_id))
-            cell.load_track(metadata)
+        locate = functools.partial(hic_location,sample_id,resolution,
+                                   datatype_string,xavi_hic_datadir)
+        jobs.append((metadata,locate))
+    log_message('cell_load_hic','Loading %d samples'%(len(jobs)))
+    return cell_bulk_load(cell,jobs,processes,threads)
 
-def load_rnaseq (sample_id,xavi_datadir='/mnt/xavi/data') :
+def rnaseq_location (sample_id,xavi_datadir='/mnt/xavi/data',index=None) :
+    """
+    Returns the location of the Kallisto abundance file of the corresponding
+    'sample_id', and the reference genome of the quantification.
+    """
     # build directory name
     rnaseq_datadir = '%s/rnaseq/samples'%xavi_datadir
     this_datadir = '%s/%s/quantifications/kallisto/'%(rnaseq_datadir,sample_id)
     # search for our file in the directory
     fname = None
-    for root,sub,files in os.walk(this_datadir) :
-        for f in files :
-            if f=='abundance.tsv' :
-                fname = '%s/abundance.tsv'%root
+    ref_genome = None
+    for path in sample_files('%s/rnaseq'%xavi_datadir,sample_id,'quantifications',
+                             'abundance.tsv',index) :
+        if path.startswith(this_datadir) and os.path.basename(path)=='abundance.tsv' :
+            fname = path
     # check that the file was found
     if fname is not None :
         ref_genome = fname.replace(this_datadir,'').replace('/paired_end/abundance.tsv','')
+    return fname, ref_genome
+
+def load_rnaseq (sample_id,xavi_datadir='/mnt/xavi/data',index=None) :
+    fname, ref_genome = rnaseq_location(sample_id,xavi_datadir,index)
     return parse_kallisto_rnaseq(fname), ref_genome
 
-def hic_bam_location(sample_id,hic_bam_datadir='/mnt/hic_bam') :
+def load_rnaseq_matrix (path,sample_ids,xavi_datadir='/mnt/xavi/data',
+                        processes=None,index=None) :
+    """
+    Returns the 'ExpressionMatrix' stored in the directory 'path', after
+    appending the samples of 'sample_ids' that it does not contain yet. The
+    Kallisto files are parsed in a pool of 'processes' worker processes.
+    """
+    matrix = ExpressionMatrix(path)
+    known = set(matrix.sample_ids())
+    fnames, metadata = [], []
+    for sample_id in sample_ids :
+        if sample_id in known :
+            continue
+        fname, ref_genome = rnaseq_location(sample_id,xavi_datadir,index)
+        if fname is None :
+            warn_message('load_rnaseq_matrix','Data not found for %s'%sample_id)
+            continue
+        known.add(sample_id)
+        fnames.append(fname)
+        metadata.append({'SAMPLE_ID' : sample_id,'ref_genome' : ref_genome})
+    if fnames :
+        matrix.add_samples(fnames,metadata,processes)
+    return matrix
+
+def hic_bam_location(sample_id,hic_bam_datadir='/mnt/hic_bam',index=None) :
     """
     Returns the location of the BAM file of the corresponding 'sample_id'
     """
-    d = "%s/samples/%s"%(hic_bam_datadir,sample_id)
-    fname = None
-    if os.path.exists(d) :
-        for root,subdirs,files in os.walk(d) :
-            for f in files :
-                if f.endswith('.bam') :
-                    fname = '%s/%s'%(root,f)
+    bamfiles = sample_files(hic_bam_datadir,sample_id,'','.bam',index)
+    fname = bamfiles[-1] if bamfiles else None
     if fname is None :
-        mbt.warn_message('hic_bam_location','Data not found for %s'%sample_id)
+        warn_message('hic_bam_location','Data not found for %s'%sample_id)
     return fname
 
-def bw_location (sample_id,xavi_datadir='/mnt/xavi/data') :
-    # build the directory name where the files are
-    d = "%s/chipseq/samples/%s/peaks"%(xavi_datadir,sample_id)
+def bw_location (sample_id,xavi_datadir='/mnt/xavi/data',index=None) :
     # select all files that end with ".bw" in the directory, and
     # then prefer to read the one that is in the directory that has
     # "with_control"
-    peakfiles = []
-    for root,sub,files in os.walk(d) :
-        for f in files :
-            if f.endswith (".bw") :
-                peakfiles.append('%s/%s'%(root,f))
-    fin = None
-    for peakfile in peakfiles :
-        if 'with_control' in peakfile :
-            fin = peakfile
-            break
-        else :
-            fin = peakfile
+    bwfiles = sample_files('%s/chipseq'%xavi_datadir,sample_id,'peaks','.bw',
+                           index)
+    fin = prefer_with_control(bwfiles)
     if fin is None :
         warn_message('bw_location','Data not found for %s'%sample_id)
     return fin
 
-def chipseq_bam_location (sample_id,xavi_datadir='/mnt/mbeato/projects/data') :
-    # build the directory name where the files are
-    d = "%s/chipseq/samples/%s/alignments"%(xavi_datadir,sample_id)
-    # select all files that end with ".bw" in the directory, and
+def chipseq_bam_location (sample_id,xavi_datadir='/mnt/mbeato/projects/data',
+                          index=None) :
+    # select all files that end with ".bam" in the directory, and
     # then prefer to read the one that is in the directory that has
     # "with_control"
-    peakfiles = []
-    for root,sub,files in os.walk(d) :
-        for f in files :
-            if f.endswith (".bam") :
-                peakfiles.append('%s/%s'%(root,f))
-    fin = None
-    for peakfile in peakfiles :
-        if 'with_control' in peakfile :
-            fin = peakfile
-            break
-        else :
-            fin = peakfile
+    bamfiles = sample_files('%s/chipseq'%xavi_datadir,sample_id,'alignments',
+                            '.bam',index)
+    fin = prefer_with_control(bamfiles)
     if fin is None :
         warn_message('chipseq_bam_location','Data not found for %s'%sample_id)
     return fin
 
-def chipseq_peaks_location (sample_id, xavi_datadir='/mnt/mbeato/projects/data') :
-    # build the directory name where the files are
-    d = "%s/chipseq/samples/%s/peaks"%(xavi_datadir,
-                                  sample_id)
+def chipseq_peaks_location (sample_id, xavi_datadir='/mnt/mbeato/projects/data',
+                            index=None) :
     # select all files that end with ".narrowPeak" in the directory, and
     # then prefer to read the one that is in the directory that has
     # "with_control"
-    peakfiles = []
-    for root,sub,files in os.walk(d) :
-        for f in files :
-            if f.endswith (".narrowPeak") :
-                peakfiles.append('%s/%s'%(root,f))
-    fin = None
-    for peakfile in peakfiles :
-        if 'with_control' in peakfile :
-            fin = peakfile
-            break
-        else :
-            fin = peakfile
+    peakfiles = sample_files('%s/chipseq'%xavi_datadir,sample_id,'peaks',
+                             '.narrowPeak',index)
+    fin = prefer_with_control(peakfiles)
     if fin is None :
         warn_message('peaks_location','Data not found for %s'%sample_id)
     return fin
 
+def _count_chromosome (job) :
+    """
+    Worker of 'count_peaks': counts the reads of the 'bam' file that overlap
+    each of the intervals [starts,ends) of 'chromosome', in one sweep over the
+    reads of the chromosome. The reads are collected in chunks of
+    'chunk_size' reads, whose counts are added up. The unmapped reads (that
+    are placed at the position of their mate) are skipped.
+    """
+    n,m,bam,chromosome,starts,ends,chunk_size = job
+    counts = np.zeros(starts.size,dtype=np.int64)
+    read_starts = np.empty(chunk_size,dtype=np.int64)
+    read_ends = np.empty(chunk_size,dtype=np.int64)
+    def flush (k) :
+        s = np.sort(read_starts[:k])
+        e = np.sort(read_ends[:k])
+        # a read overlaps [start,end) if it starts before 'end' and does not
+        # end before 'start': the reads that end before 'start' all start
+        # before 'end'
+        counts[:] += np.searchsorted(s,ends,side='left') -\
+                     np.searchsorted(e,starts,side='right')
+    with pysam.AlignmentFile(bam,'rb') as samfile :
+        if chromosome not in samfile.references :
+            return n,m,counts
+        k = 0
+        for read in samfile.fetch(chromosome) :
+            if read.is_unmapped or read.reference_end is None :
+                continue
+            read_starts[k] = read.reference_start
+            read_ends[k] = read.reference_end
+            k += 1
+            if k == chunk_size :
+                flush(k)
+                k = 0
+        flush(k)
+    return n,m,counts
+
+def count_peaks (peaks,bams,extend=None,processes=None,chunk_size=1000000) :
+    """
+    Counts the reads of each of the 'bams' files that overlap each of the
+    'peaks' (as returned by 'parse_narrowpeak'), optionally extended by
+    'extend' base pairs on both sides. The peaks are grouped by chromosome,
+    and the reads of each chromosome of each bam file are counted in a single
+    sweep, in a pool of 'processes' worker processes, collecting the reads in
+    chunks of 'chunk_size' reads. Returns the matrix of counts, with one row
+    per peak and one column per bam file.
+    """
+    peaks = np.atleast_1d(peaks)
+    starts = peaks['start'].astype(np.int64)
+    ends = peaks['end'].astype(np.int64)
+    if extend is not None :
+        starts = np.maximum(starts-extend,0)
+        ends = ends+extend
+    chromosomes,inverse = np.unique(peaks['chr'],return_inverse=True)
+    groups = [np.flatnonzero(inverse==k) for k in range(chromosomes.size)]
+    jobs = []
+    for m,bam in enumerate(bams) :
+        for n,chromosome in enumerate(chromosomes) :
+            idx = groups[n]
+            jobs.append((n,m,bam,chromosome_key(chromosome),starts[idx],ends[idx],
+                         chunk_size))
+    counts = np.zeros((peaks.size,len(bams)),dtype=np.int64)
+    for n,m,c in parallel_map(_count_chromosome,jobs,processes,ordered=False) :
+        counts[groups[n],m] = c
+    return counts
+
 class ChIPseq :
     def __init__(self, sample_id, xavi_datadir='/mnt/mbeato/projects/data') :
         self.sample_id = sample_id
@@ -189,5 +429,25 @@ class ChIPseq :
         chromosome = str(chromosome)
         # use the BigWig parser to get the stats of the peak
         return self.bam.count(chromosome,start,end)
+    def count_peaks(self,peaks=None,extend=None,processes=None) :
+        """
+        Returns the number of reads under each of the 'peaks' (by default, the
+        peaks of the sample). See 'count_peaks'.
+        """
+        if peaks is None :
+            peaks = self.peaks
+        return count_peaks(peaks,[self.bam_file],extend,processes)[:,0]
+    def coverage(self,chromosome,resolution,extend=None) :
+        """
+        Returns the binned fragment coverage of 'chromosome'. See
+        'bam_coverage'.
+        """
+        return bam_coverage(self.bam_file,chromosome,resolution,extend)
+    def coverage_track(self,extend=None) :
+        """
+        Returns the CoverageTrack of the sample, to be used as the data of a
+        'coverage' track of a CellLine or Region.
+        """
+        return CoverageTrack(self.bam_file,extend)
     def __del__(self) :
         self.bam.close()
@@ -2,58 +2,83 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 import os
+import pickle
+import functools
+import scipy.sparse as sp
 from .parsers import parse_hic, parse_narrowpeak
+from .hicmatrix import HiCMatrix
+from .peakindex import PeakIndex
+from .coverage import CoverageTrack
+from .tracks import LazyTrack, TrackCache, TrackCatalog, match_condition
 from .vistools import line_plot
-from .utils import warn_message
+from .parsercache import atomic_write, save_pickle
+from .utils import warn_message, mkdir_p, chromosome_key
 
-def region_chipseq (track,chromosome,start,end,resolution,q_threshold=None) :
+def region_chipseq (track,chromosome,start,end,resolution,q_threshold=None,
+                    aggregate='max') :
     """
     This function is a fundamental component that allows to map the chipseq
     track to a particular chromosome region, at a given resolution. Optional
     'q_threshold' parameter tells whether a threshold on the peak quality should
-    be applied.
+    be applied. The values of the peaks that fall into the same bin are
+    aggregated with the 'aggregate' function, one of 'max', 'sum' or 'mean'.
+    The peaks are looked up in the 'index' of the track, if present. For the
+    'coverage' tracks (see 'CoverageTrack'), returns the binned coverage of
+    the region.
     """
+    if isinstance(track['data'],CoverageTrack) :
+        return track['data'].profile (chromosome,start,end,resolution)
+    index = track.get('index')
+    if index is None :
+        index = PeakIndex(track['data'])
     x = np.arange (start,end,resolution)
-    y = np.zeros_like (x,dtype=np.float64)
-    for peak in track['data'] :
-        if (peak['chr'] == chromosome) and\
-           (peak['start'] > start)     and\
-           (peak['start'] < end) :
-            i_peak = (peak['start']-start)/resolution
-            if q_threshold is not None :
-                if peak['q'] < q_threshold :
-                    continue
-            y[i_peak] = peak['val']
+    y = index.bin_values (chromosome,start,end,resolution,
+                          q_threshold=q_threshold,aggregate=aggregate)
     return x,y
 
-def region_hic (hic,chromosome,start,end,resolution) :
-    try :
-        # get all the values that correspond to the Region's chromosome and
-        # extension
-        mask = np.logical_and (hic['data']['chr']==chromosome,
-                               np.logical_and(hic['data']['i']>=start,
-                                              hic['data']['j']<end))
-        rawH = hic['data'][mask]
-        # set the values of the matrix
-        N = (end-start)/resolution
-        H = np.zeros((N,N),dtype=rawH['val'].dtype)
-        for h in rawH :
-            i = (h['i']-start)/resolution
-            j = (h['j']-start)/resolution
-            H[i,j] = H[j,i] = h['val']
-    except IndexError :
-        H = hic['data']
-    return H
+def region_hic (hic,chromosome,start,end,resolution,sparse=False) :
+    """
+    Extracts the Hi-C matrix of the region (chromosome, start, end) from the
+    'hic' track, whose data is either the array returned by 'parse_hic' or a
+    HiCMatrix. If 'sparse' is True, returns a HiCMatrix instead of the dense
+    matrix. The region of a chromosome other than that of a HiCMatrix is
+    empty, and a HiCMatrix cannot be extracted at another resolution.
+    """
+    data = hic['data']
+    if isinstance(data,HiCMatrix) :
+        if resolution != data.resolution :
+            raise ValueError ("The Hi-C matrix has resolution %d, not %d"%(
+                              data.resolution,resolution))
+        if chromosome_key(chromosome) == chromosome_key(data.chromosome) :
+            H = data.region(start,end)
+        else :
+            N = (end-start)//resolution
+            H = HiCMatrix(sp.csr_matrix((N,N),dtype=data.matrix.dtype),
+                          chromosome,start,resolution)
+    else :
+        try :
+            H = HiCMatrix.from_records(data,chromosome,resolution,start,end)
+        except IndexError :
+            # not a records array: the matrix was given as is
+            return data
+    if sparse :
+        return H
+    return H.toarray()
 
 def select_tracks (tracks,conditions) :
+    """
+    Returns the tracks that satisfy all the 'conditions', a dictionary in
+    which the keys are metadata fields and the values are conditions on the
+    field (see 'match_condition').
+    """
     selected_tracks = []
     if not conditions :
         return tracks
     for track in tracks :
         is_valid = True
-        for key,val in conditions.iteritems() :
+        for key,val in conditions.items() :
             try :
-                if track[key] != val :
+                if not match_condition (track[key],val) :
                     is_valid = False
                     break
             except KeyError :
@@ -63,14 +88,64 @@ def select_tracks (tracks,conditions) :
             selected_tracks.append(track)
     return selected_tracks
 
+# the file of a CellLine snapshot with the metadata of its tracks
+SNAPSHOT_INDEX = 'tracks.pkl'
+
+def _save_track_data (path,prefix,data) :
+    """
+    Saves the 'data' of a track in the snapshot directory 'path', in the
+    files whose names start with 'prefix'. The arrays, and the arrays of the
+    HiCMatrix objects, are saved in .npy files, and the other objects are
+    pickled. Returns the description of the saved data, to be passed to
+    '_load_track_data'.
+    """
+    if isinstance(data,np.ndarray) and not data.dtype.hasobject :
+        atomic_write('%s/%s.npy'%(path,prefix),data,np.save)
+        return ('array',)
+    if isinstance(data,HiCMatrix) :
+        for field in ('data','indices','indptr') :
+            atomic_write('%s/%s.%s.npy'%(path,prefix,field),
+                         getattr(data.matrix,field),np.save)
+        return ('hic',data.shape,data.chromosome,data.start,data.resolution)
+    atomic_write('%s/%s.pkl'%(path,prefix),data,save_pickle)
+    return ('pickle',)
+
+def _load_track_data (path,prefix,kind) :
+    """
+    Loads the data of a track saved by '_save_track_data'. The arrays are
+    memory-mapped (copy-on-write).
+    """
+    if kind[0] == 'array' :
+        return np.load('%s/%s.npy'%(path,prefix),mmap_mode='c')
+    if kind[0] == 'hic' :
+        shape,chromosome,start,resolution = kind[1:]
+        arrays = tuple(np.load('%s/%s.%s.npy'%(path,prefix,field),mmap_mode='c')
+                       for field in ('data','indices','indptr'))
+        return HiCMatrix.from_csr(sp.csr_matrix(arrays,shape=shape),chromosome,
+                                  start,resolution)
+    with open('%s/%s.pkl'%(path,prefix),'rb') as f :
+        return pickle.load(f)
+
 class CellLine :
-    def __init__ (self,name) :
+    def __init__ (self,name,lazy=False,memory_budget=None) :
+        """
+        If 'lazy' is True, the tracks are parsed only when their data is first
+        accessed. If 'memory_budget' is given (in bytes), the tracks are lazy,
+        and the parsed data of the least recently used tracks is dropped when
+        the total exceeds the budget, to be parsed again when needed (this is
+        cheap when the parser cache is enabled, see 'enable_parser_cache').
+        """
         self.name = name
-        self._data = []
+        self._data = TrackCatalog()
+        self.lazy = lazy or memory_budget is not None
+        self.cache = None
+        if memory_budget is not None :
+            self.cache = TrackCache(memory_budget)
         # these are the parsers that are currently available
         self.parsers = {'hic'         :           parse_hic,
-                        'chipseq'     :           parse_narrowpeak}
-    def load_track (self,metadata) :
+                        'chipseq'     :           parse_narrowpeak,
+                        'coverage'    :           CoverageTrack}
+    def load_track (self,metadata,data=None) :
         """
         Loads a single track of data to the CellLine's data track list. To do
         so, it uses the user-supplied 'metadata' dictionary to evince two
@@ -80,7 +155,10 @@ class CellLine :
         The function then attempts to read the fname using the corresponding
         parser. If successful, then a track is added to the records, which can
         then be accessed by the 'get_data' function. All the remaining keys and
-        values in the metadata dictionary are copied to the record.
+        values in the metadata dictionary are copied to the record. If the
+        CellLine is lazy, the file is parsed only when the 'data' of the track
+        is first accessed. If the file was already parsed, its 'data' can be
+        passed directly, and the parser is not called.
         """ 
         # sanity check on the metadata: has fname and type keys
         try :
@@ -98,26 +176,91 @@ class CellLine :
             raise IOError ("%s does not exist"%fname)
         # sanity check on the fact that the same track has not been loaded
         # already
-        previous = select_tracks(self._data,{'fname':fname})
+        previous = self._data.select({'fname':fname})
         if previous :
             warn_message('load_track','Track %s already loaded'%fname)
             return
         # everything's fine: load the data and append the record to the records.
-        datadict = metadata.copy()
-        datadict['data'] = self.parsers[datatype](fname)
+        loader = lambda : self._load_payload(datatype,fname)
+        if data is not None :
+            datadict = metadata.copy()
+            datadict.update(self._make_payload(datatype,data))
+        elif self.lazy :
+            datadict = LazyTrack(metadata,loader,self.cache)
+        else :
+            datadict = metadata.copy()
+            datadict.update(loader())
         self._data.append (datadict)
+    def _load_payload (self,datatype,fname) :
+        """
+        Parses the file 'fname' of the given 'datatype', and returns the
+        dictionary with its 'data' and the structures derived from it.
+        """
+        return self._make_payload(datatype,self.parsers[datatype](fname))
+    def _make_payload (self,datatype,data) :
+        """
+        Returns the dictionary with the parsed 'data' of a track of the given
+        'datatype' and the structures derived from it.
+        """
+        payload = {'data' : data}
+        if datatype == 'chipseq' :
+            payload['index'] = PeakIndex(payload['data'])
+        return payload
+    def _open_payload (self,path,datatype,prefix,kind) :
+        """
+        Returns the payload of a track of the snapshot 'path' (see 'open').
+        """
+        return self._make_payload(datatype,_load_track_data(path,prefix,kind))
+    def save (self,path) :
+        """
+        Saves the CellLine in the directory 'path', to be re-opened with
+        'CellLine.open'. The data of each track is saved in its own files:
+        the arrays in .npy files, that are memory-mapped when the CellLine is
+        re-opened, and the other objects (as a CoverageTrack) in pickle
+        files. The metadata of all the tracks is saved in one file, that is
+        written last.
+        """
+        mkdir_p(path)
+        records = []
+        for n,track in enumerate(self._data.tracks) :
+            prefix = 'track%05d'%n
+            metadata = dict((key,val) for key,val in dict.items(track)
+                            if key not in LazyTrack.lazy_keys)
+            kind = _save_track_data(path,prefix,track['data'])
+            records.append((metadata,prefix,kind))
+        atomic_write('%s/%s'%(path,SNAPSHOT_INDEX),
+                     {'name' : self.name,'tracks' : records},save_pickle)
+    @classmethod
+    def open (cls,path,memory_budget=None) :
+        """
+        Opens the CellLine saved in the directory 'path' (see 'save'). Only
+        the metadata of the tracks is read: the tracks are lazy, and their
+        data is memory-mapped when it is first accessed, so that it is paged
+        in from disk only where it is used. See the constructor for the
+        meaning of 'memory_budget'.
+        """
+        with open('%s/%s'%(path,SNAPSHOT_INDEX),'rb') as f :
+            snapshot = pickle.load(f)
+        cell = cls(snapshot['name'],lazy=True,memory_budget=memory_budget)
+        for metadata,prefix,kind in snapshot['tracks'] :
+            loader = functools.partial(cell._open_payload,path,
+                                       metadata.get('type'),prefix,kind)
+            cell._data.append (LazyTrack(metadata,loader,cell.cache))
+        return cell
     def get_data (self,conditions) :
         """
         Returns a list of tracks loaded into the CellLine by specifying one or
         more 'conditions'. The conditions are to be specified by a dictionary in
         which the keys correspond to metadata fields, and the values to the
-        desired value of that field.
+        desired value of that field, to a set or list of values, or to a slice
+        of values (see 'match_condition'). The tracks are looked up in the
+        index of the metadata.
         """
-        return select_tracks (self.data,conditions)
+        return self._data.select (conditions)
 
     @property
     def data (self) :
-        return self._data
+        return self._data.tracks
     @data.setter
     def data(self,track) :
         # TODO: sanity checks
@@ -128,49 +271,47 @@ class Region :
         self.chromosome = chromosome
         self.start = start
         self.end = end
+        self.resolution = resolution
         self._data = []
-    def set_chipseq_track (self,track,resolution,q_threshold=None) :
+    def set_chipseq_track (self,track,resolution=None,q_threshold=None,
+                           aggregate='max') :
         """
         This function passes the 'track' dictionary to the Region class and
         coarse-grains its values to the xvals desired. The 'track' must have
         the structure as given by the CellLine class, plus an additional
-        parameter 'resolution', which is the coarse-graining parameter. The
-        optional argument 'q_threshold' can be passed to select the peaks that
-        meet a certain quality threshold.
+        parameter 'resolution', which is the coarse-graining parameter (by
+        default, the resolution of the Region). The optional argument
+        'q_threshold' can be passed to select the peaks that meet a certain
+        quality threshold, and 'aggregate' tells how to combine the peaks that
+        fall into the same bin.
         """
+        if resolution is None :
+            resolution = self.resolution
         mytrack = {}
-        for key,val in track.iteritems () :
-            if key != 'data' :
+        for key,val in track.items () :
+            if key not in ('data','index') :
                 mytrack[key] = val
         mytrack['xvals'], mytrack['track'] = region_chipseq (track,
                                                              self.chromosome,
                                                              self.start,
                                                              self.end,
-                                                             resolution)
+                                                             resolution,
+                                                             q_threshold,
+                                                             aggregate)
         self._data.append (mytrack)
-    def set_hic (self,hic) :
+    def set_hic (self,hic,sparse=False) :
+        """
+        Adds the Hi-C matrix of the Region, extracted from the 'hic' track at
+        the resolution given by its 'resolution' key. If 'sparse' is True, the
+        matrix is stored as a HiCMatrix.
+        """
         mytrack = {}
-        for key,val in hic.iteritems () :
+        for key,val in hic.items () :
             if key != 'data' :
                 mytrack[key] = val
-        try :
-            # now get all the values that correspond to the Region's chromosome and
-            # extension
-            mask = np.logical_and (hic['data']['chr']==self.chromosome,
-                                   np.logical_and(hic['data']['start']>=self.start,
-                                                  hic['data']['end']<self.end))
-            rawH = hic['data'][mask]
-            # set the values of the matrix
-            N = (self.end-self.start)/mytrack['resolution']
-            H = np.zeros((N,N),dtype=rawH['val'].dtype)
-            for h in rawH :
-                i = (h['start']-self.start)/mytrack['resolution']
-                j = (h['end']-self.start)/mytrack['resolution']
-                H[i,j] = H[j,i] = h['val']
-        except IndexError :
-            H = hic['data']
+        mytrack['track'] = region_hic (hic,self.chromosome,self.start,self.end,
+                                       mytrack['resolution'],sparse=sparse)
         # and finally update the Region's data records
-        mytrack['track'] = H
         self._data.append (mytrack)
     def set_data (self,cell,conditions,q_threshold=None) :
         """
@@ -181,7 +322,7 @@ class Region :
         """
         tracks = cell.get_data (conditions)
         for track in tracks :
-            if track['type'] == 'chipseq' :
+            if track['type'] in ('chipseq','coverage') :
                 self.set_chipseq_track(track,q_threshold=q_threshold)
             elif track['type'] == 'hic' :
                 self.set_hic(track)
@@ -206,3 +347,129 @@ class Region :
     def data(self,track) :
         # TODO: sanity check
         self._data.append (track)
+
+class RegionSet :
+    """
+    A set of genomic windows of the same length, as in the 'windows' array
+    with the 'chr', 'start' and 'end' fields (see 'parse_simple_bed'), at the
+    given 'resolution'. The tracks of all the windows are extracted in one
+    vectorized pass per chromosome, and stored as stacked arrays with one
+    row per window.
+    """
+    def __init__ (self,windows,resolution) :
+        self.windows = np.atleast_1d(windows)
+        lengths = np.unique(self.windows['end']-self.windows['start'])
+        if lengths.size > 1 :
+            raise ValueError ("All the windows must have the same length")
+        self.length = int(lengths[0]) if lengths.size else 0
+        self.resolution = resolution
+        self._data = []
+    @classmethod
+    def tile (cls,chromosome,start,end,size,resolution,step=None) :
+        """
+        Returns the RegionSet of the windows of length 'size' that tile the
+        region (chromosome, start, end), every 'step' base pairs (by default,
+        'size').
+        """
+        if step is None :
+            step = size
+        starts = np.arange(start,end-size+1,step)
+        windows = np.zeros(starts.size,dtype=[('chr','S256'),
+                                              ('start',np.int64),
+                                              ('end',np.int64)])
+        windows['chr'] = chromosome
+        windows['start'] = starts
+        windows['end'] = starts+size
+        return cls(windows,resolution)
+    def __len__ (self) :
+        return self.windows.size
+    def _chromosome_groups (self) :
+        """
+        Yields the chromosomes of the windows, with the positions of their
+        windows.
+        """
+        chromosomes,inverse = np.unique(self.windows['chr'],return_inverse=True)
+        for k,chromosome in enumerate(chromosomes) :
+            yield chromosome,np.flatnonzero(inverse==k)
+    def _metadata (self,track) :
+        mytrack = {}
+        for key,val in dict.items(track) :
+            if key not in ('data','index') :
+                mytrack[key] = val
+        return mytrack
+    def set_chipseq_track (self,track,q_threshold=None,aggregate='max') :
+        """
+        Adds the ChIP-seq 'track' binned over all the windows (see
+        'region_chipseq' for the meaning of the arguments). The 'xvals' and
+        'track' of the record are arrays with one row per window.
+        """
+        if isinstance(track['data'],CoverageTrack) :
+            index = None
+        else :
+            index = track.get('index')
+            if index is None :
+                index = PeakIndex(track['data'])
+        nbins = len(range(0,self.length,self.resolution))
+        Y = np.zeros((len(self),nbins))
+        for chromosome,idx in self._chromosome_groups() :
+            starts = self.windows['start'][idx]
+            if index is None :
+                Y[idx] = track['data'].windows(chromosome,starts,self.length,
+                                               self.resolution)
+            else :
+                Y[idx] = index.bin_windows(chromosome,starts,self.length,
+                                           self.resolution,
+                                           q_threshold=q_threshold,
+                                           aggregate=aggregate)
+        mytrack = self._metadata(track)
+        mytrack['xvals'] = self.windows['start'][:,None] +\
+                           np.arange(nbins)*self.resolution
+        mytrack['track'] = Y
+        self._data.append (mytrack)
+    def set_hic (self,hic) :
+        """
+        Adds the Hi-C matrices of all the windows, extracted from the 'hic'
+        track, whose data is either the array returned by 'parse_hic' or a
+        HiCMatrix. The 'track' of the record is the stack of the matrices.
+        The windows must be aligned to the bins of the track.
+        """
+        data = hic['data']
+        N = self.length//self.resolution
+        H = None
+        for chromosome,idx in self._chromosome_groups() :
+            if isinstance(data,HiCMatrix) :
+                if chromosome_key(chromosome) != chromosome_key(data.chromosome) :
+                    continue
+                chrom_matrix = data
+            else :
+                # the matrix of the whole chromosome, built once
+                chrom_matrix = HiCMatrix.from_records(data,chromosome,
+                                                      self.resolution)
+            if H is None :
+                H = np.zeros((len(self),N,N),dtype=chrom_matrix.matrix.dtype)
+            for k in idx :
+                H[k] = chrom_matrix.region(self.windows['start'][k],
+                                           self.windows['end'][k]).toarray()
+        if H is None :
+            H = np.zeros((len(self),N,N))
+        mytrack = self._metadata(hic)
+        mytrack['track'] = H
+        self._data.append (mytrack)
+    def set_data (self,cell,conditions,q_threshold=None) :
+        """
+        Adds the tracks of the CellLine 'cell' that satisfy the 'conditions'
+        to the RegionSet's records, as in 'Region.set_data'.
+        """
+        tracks = cell.get_data (conditions)
+        for track in tracks :
+            if track['type'] in ('chipseq','coverage') :
+                self.set_chipseq_track(track,q_threshold=q_threshold)
+            elif track['type'] == 'hic' :
+                self.set_hic(track)
+            else :
+                raise ValueError ("Unsupported data type %s"%track['type'])
+    def get_data (self,conditions) :
+        return select_tracks (self._data,conditions)
+    @property
+    def data(self) :
+        return self._data
@@ -0,0 +1,113 @@
+import numpy as np
+import pysam
+from .parsers import SAM_SKIP_FLAGS
+from .parsercache import cached_array
+from .utils import chromosome_key
+
+def _accumulate_coverage (cov,diff,s,e,resolution) :
+    """
+    Adds to 'cov' the number of base pairs of each bin covered by the
+    fragments [s,e). The bins that are fully covered by a fragment are
+    accumulated in the difference array 'diff'.
+    """
+    nbins = cov.size
+    first = s//resolution
+    last = (e-1)//resolution
+    same = first==last
+    cov += np.bincount(first[same],weights=(e-s)[same],minlength=nbins)
+    first,last,s,e = first[~same],last[~same],s[~same],e[~same]
+    cov += np.bincount(first,weights=(first+1)*resolution-s,minlength=nbins)
+    cov += np.bincount(last,weights=e-last*resolution,minlength=nbins)
+    diff += np.bincount(first+1,minlength=nbins+1)*float(resolution)
+    diff -= np.bincount(last,minlength=nbins+1)*float(resolution)
+
+def bam_coverage (bam,chromosome,resolution,extend=None,
+                  skip_flags=SAM_SKIP_FLAGS,chunk_size=1000000) :
+    """
+    Returns the fragment coverage of 'chromosome' in the 'bam' file, binned at
+    the given 'resolution', as the mean number of fragments that cover each
+    base pair of the bin. If 'extend' is given, each read is extended to a
+    fragment of 'extend' base pairs in the direction of its strand. The reads
+    whose flag has any of the bits of 'skip_flags' are ignored. The reads are
+    streamed and accumulated in chunks of 'chunk_size' reads.
+    """
+    chromosome = chromosome_key(chromosome)
+    with pysam.AlignmentFile(bam,'rb') as samfile :
+        length = samfile.get_reference_length(chromosome)
+        nbins = length//resolution + 1
+        cov = np.zeros(nbins)
+        diff = np.zeros(nbins+1)
+        start = np.empty(chunk_size,dtype=np.int64)
+        end = np.empty(chunk_size,dtype=np.int64)
+        reverse = np.empty(chunk_size,dtype=bool)
+        def flush (n) :
+            s,e = start[:n],end[:n]
+            if extend is not None :
+                rev = reverse[:n]
+                s = np.where(rev,e-extend,s)
+                e = np.where(rev,e,s+extend)
+            s = np.clip(s,0,length)
+            e = np.clip(e,0,length)
+            valid = e>s
+            _accumulate_coverage(cov,diff,s[valid],e[valid],resolution)
+        n = 0
+        for read in samfile.fetch(chromosome) :
+            if read.flag & skip_flags :
+                continue
+            start[n] = read.reference_start
+            end[n] = read.reference_end
+            reverse[n] = read.is_reverse
+            n += 1
+            if n == chunk_size :
+                flush(n)
+                n = 0
+        flush(n)
+    return (cov + np.cumsum(diff)[:nbins])/resolution
+
+class CoverageTrack :
+    """
+    The binned coverage of a ChIP-seq bam file, computed for each chromosome
+    and resolution on first request (see 'bam_coverage'). The binned arrays
+    are kept in memory, and stored in the parser cache when it is enabled
+    (see 'enable_parser_cache').
+    """
+    def __init__ (self,fname,extend=None) :
+        self.fname = fname
+        self.extend = extend
+        self._arrays = {}
+    @property
+    def nbytes (self) :
+        """
+        The number of bytes of the binned coverage arrays computed so far.
+        """
+        return sum(a.nbytes for a in self._arrays.values())
+    def chromosome (self,chromosome,resolution) :
+        """
+        Returns the binned coverage of the whole 'chromosome'.
+        """
+        key = (chromosome_key(chromosome),resolution)
+        if key not in self._arrays :
+            tag = 'bam_coverage:%s:%d:%r'%(key[0],resolution,self.extend)
+            self._arrays[key] = cached_array(self.fname,tag,
+                lambda : bam_coverage(self.fname,key[0],resolution,self.extend))
+        return self._arrays[key]
+    def windows (self,chromosome,starts,length,resolution) :
+        """
+        Returns the matrix of the coverage of the windows
+        [start,start+length) of 'chromosome', one row for each of the
+        'starts', binned at the given 'resolution'. The bins that fall outside
+        of the chromosome are zero.
+        """
+        cov = self.chromosome(chromosome,resolution)
+        x = np.asarray(starts,dtype=np.int64)[:,None] +\
+            np.arange(0,length,resolution)
+        bins = x//resolution
+        inside = (bins>=0) & (bins<cov.size)
+        return np.where(inside,cov[np.clip(bins,0,cov.size-1)],0.)
+    def profile (self,chromosome,start,end,resolution) :
+        """
+        Returns the genomic coordinates and the coverage of the bins of the
+        region (chromosome, start, end).
+        """
+        x = np.arange(start,end,resolution)
+        return x,self.windows(chromosome,[start],end-start,resolution)[0]
@@ -0,0 +1,130 @@
+import os
+import json
+import numpy as np
+from .parsers import parse_kallisto_rnaseq
+from .parsercache import atomic_write, save_json
+from .utils import mkdir_p, parallel_map
+
+# the quantities of the Kallisto output that are stored in the matrix
+EXPRESSION_FIELDS = ('est_counts','tpm')
+
+def _parse_expression (fname) :
+    """
+    Worker of 'ExpressionMatrix.add_samples': parses the Kallisto file and
+    returns the target ids, trimmed to their maximum length, and the arrays
+    of the expression fields.
+    """
+    a = parse_kallisto_rnaseq(fname)
+    ids = a['target_id']
+    ids = ids.astype('S%d'%max(1,np.char.str_len(ids).max()))
+    return ids,a['length'],[np.array(a[field]) for field in EXPRESSION_FIELDS]
+
+class ExpressionMatrix :
+    """
+    A targets x samples matrix of the RNA-seq expression quantified by
+    Kallisto, stored in the directory 'path'. The target ids are encoded once,
+    in the order of the first sample, and each expression field (see
+    EXPRESSION_FIELDS) is stored in a binary file with one contiguous record
+    per sample, written at the offset of the sample, so that new samples are
+    appended without rewriting the matrix. The matrices are memory-mapped.
+    """
+    def __init__ (self,path) :
+        self.path = path
+        self.target_ids = None
+        self.lengths = None
+        self.samples = []
+        if os.path.exists('%s/samples.json'%path) :
+            with open('%s/samples.json'%path,'r') as f :
+                self.samples = json.load(f)
+            self.target_ids = np.load('%s/target_ids.npy'%path)
+            self.lengths = np.load('%s/lengths.npy'%path)
+        self._order = None
+    def _row_offset (self,n) :
+        """
+        Returns the offset in the binary files of the row of the sample 'n'.
+        """
+        if self.target_ids is None :
+            return 0
+        return n*self.target_ids.size*np.dtype(np.float64).itemsize
+    @property
+    def shape (self) :
+        if self.target_ids is None :
+            return (0,0)
+        return (self.target_ids.size,len(self.samples))
+    def matrix (self,field='tpm') :
+        """
+        Returns the memory-mapped targets x samples matrix of 'field'.
+        """
+        if field not in EXPRESSION_FIELDS :
+            raise KeyError ("Unknown expression field %s"%field)
+        if not self.samples :
+            return np.zeros(self.shape)
+        # only the rows of the recorded samples are mapped: the binary files
+        # may hold the rows of an interrupted 'add_samples'
+        M = np.memmap('%s/%s.bin'%(self.path,field),dtype=np.float64,mode='r',
+                      shape=(len(self.samples),self.target_ids.size))
+        return M.T
+    @property
+    def tpm (self) :
+        return self.matrix('tpm')
+    @property
+    def est_counts (self) :
+        return self.matrix('est_counts')
+    def sample_ids (self,key='SAMPLE_ID') :
+        return [s.get(key) for s in self.samples]
+    def _positions (self,ids) :
+        """
+        Returns the positions of the target 'ids' in the encoded target ids.
+        """
+        if ids.size == self.target_ids.size and np.array_equal(ids,self.target_ids) :
+            return np.arange(ids.size)
+        if self._order is None :
+            self._order = np.argsort(self.target_ids)
+        sorted_ids = self.target_ids[self._order]
+        k = np.clip(np.searchsorted(sorted_ids,ids),0,sorted_ids.size-1)
+        if not np.array_equal(sorted_ids[k],ids) :
+            raise ValueError ("The targets do not match those of the matrix")
+        return self._order[k]
+    def add_samples (self,fnames,metadata=None,processes=None) :
+        """
+        Parses the Kallisto files 'fnames' in a pool of 'processes' worker
+        processes, and appends them to the matrix as new samples, with the
+        corresponding 'metadata' dictionaries.
+        """
+        if metadata is None :
+            metadata = [{} for fname in fnames]
+        mkdir_p(self.path)
+        self._truncate()
+        results = parallel_map(_parse_expression,fnames,processes)
+        for (ids,lengths,values),fname,meta in zip(results,fnames,metadata) :
+            if self.target_ids is None :
+                self.target_ids = ids
+                self.lengths = lengths
+                np.save('%s/target_ids.npy'%self.path,ids)
+                np.save('%s/lengths.npy'%self.path,lengths)
+            pos = self._positions(ids)
+            for field,v in zip(EXPRESSION_FIELDS,values) :
+                row = np.zeros(self.target_ids.size)
+                row[pos] = v
+                binname = '%s/%s.bin'%(self.path,field)
+                mode = 'r+b' if os.path.exists(binname) else 'wb'
+                with open(binname,mode) as f :
+                    f.seek(self._row_offset(len(self.samples)))
+                    f.write(row.tobytes())
+            record = dict(meta)
+            record['fname'] = fname
+            self.samples.append(record)
+            self._save_samples()
+    def _truncate (self) :
+        """
+        Drops the rows of the samples that were written to the binary files
+        but not recorded, as after an interrupted 'add_samples', so that the
+        new samples are appended after the recorded ones.
+        """
+        for field in EXPRESSION_FIELDS :
+            binname = '%s/%s.bin'%(self.path,field)
+            if os.path.exists(binname) :
+                with open(binname,'r+b') as f :
+                    f.truncate(self._row_offset(len(self.samples)))
+    def _save_samples (self) :
+        atomic_write('%s/samples.json'%self.path,self.samples,save_json)
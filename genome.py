@@ -0,0 +1,123 @@
+import os
+import numpy as np
+from .utils import chromosome_key
+
+# the chromosome sizes files of the known assemblies, relative to $HOME
+GENOME_FILES = {'hg19' : 'work/data/human/genome_size.dat',
+                'hg38' : 'work/data/human/hg38.chrom.sizes',
+                'mm10' : 'work/data/mouse/mm10.chrom.sizes'}
+
+# the genomes that were already loaded, by assembly name
+_genomes = {}
+
+class Genome :
+    """
+    The chromosomes of a genome assembly and their sizes, usually read from a
+    chrom.sizes or a .fai file with 'from_file' (only the first two columns
+    are used). Keeps the cumulative bin offsets of the chromosomes at each
+    resolution, to convert genomic coordinates to genome-wide bin indices and
+    back.
+    """
+    def __init__ (self,chromosomes,sizes,assembly=None) :
+        self.assembly = assembly
+        self.chromosomes = [chromosome_key(c) for c in chromosomes]
+        self.sizes = np.array(sizes,dtype=np.int64)
+        self._ids = dict((c,i) for i,c in enumerate(self.chromosomes))
+        self._offsets = {}
+    @classmethod
+    def from_file (cls,fname,assembly=None) :
+        """
+        Reads the genome from the chrom.sizes or .fai file 'fname'.
+        """
+        names = []
+        sizes = []
+        with open (fname,'r') as f :
+            for line in f :
+                curatedline = line.strip('\n').split()
+                if not curatedline or curatedline[0].startswith('#') :
+                    continue
+                names.append(curatedline[0])
+                sizes.append(int(curatedline[1]))
+        return cls(names,sizes,assembly)
+    def chromosome_id (self,chromosome) :
+        """
+        Returns the index of 'chromosome' in the genome, or -1 if it does not
+        exist.
+        """
+        return self._ids.get(chromosome_key(chromosome),-1)
+    def chromosome_ids (self,chromosomes) :
+        """
+        Vectorized version of 'chromosome_id' for an array of names.
+        """
+        names,inverse = np.unique(np.asarray(chromosomes),return_inverse=True)
+        ids = np.array([self.chromosome_id(c) for c in names],dtype=np.int64)
+        return ids[inverse].reshape(np.shape(chromosomes))
+    def size (self,chromosome) :
+        """
+        Returns the size in base pairs of 'chromosome', or 0 if it does not
+        exist.
+        """
+        i = self.chromosome_id(chromosome)
+        return int(self.sizes[i]) if i>=0 else 0
+    def nbins (self,chromosome,resolution) :
+        """
+        Returns the number of bins of 'chromosome' at the given 'resolution'.
+        """
+        return self.size(chromosome)//resolution + 1
+    def bin_offsets (self,resolution) :
+        """
+        Returns the array of the genome-wide index of the first bin of each
+        chromosome at the given 'resolution'. The last element is the total
+        number of bins of the genome.
+        """
+        if resolution not in self._offsets :
+            self._offsets[resolution] = np.r_[0,np.cumsum(self.sizes//resolution+1)]
+        return self._offsets[resolution]
+    def to_bins (self,chromosomes,positions,resolution) :
+        """
+        Converts the genomic coordinates (chromosomes, positions) to
+        genome-wide bin indices at the given 'resolution'. The chromosomes can
+        be given either by name or by index. Coordinates on unknown
+        chromosomes are mapped to -1.
+        """
+        chromosomes = np.asarray(chromosomes)
+        if chromosomes.dtype.kind in 'SUO' :
+            chromosomes = self.chromosome_ids(chromosomes)
+        offsets = self.bin_offsets(resolution)
+        bins = offsets[chromosomes] + np.asarray(positions)//resolution
+        return np.where(chromosomes>=0,bins,-1)
+    def from_bins (self,bins,resolution) :
+        """
+        Converts the genome-wide bin indices to genomic coordinates. Returns
+        the arrays of chromosome indices and of the start of the bins. Raises
+        IndexError if a bin is outside of the genome.
+        """
+        bins = np.asarray(bins)
+        offsets = self.bin_offsets(resolution)
+        if bins.size and (bins.min()<0 or bins.max()>=offsets[-1]) :
+            raise IndexError ("Bin out of range for the %d bins of the genome"%
+                              offsets[-1])
+        chromosomes = np.searchsorted(offsets,bins,side='right')-1
+        return chromosomes,(bins-offsets[chromosomes])*resolution
+
+def register_genome (assembly,fname) :
+    """
+    Sets the chrom.sizes or .fai file 'fname' to use for 'assembly'.
+    """
+    GENOME_FILES[assembly] = fname
+    _genomes.pop(assembly,None)
+
+def get_genome (assembly='hg19') :
+    """
+    Returns the Genome of the given 'assembly'. The chromosome sizes are read
+    only the first time that the assembly is requested.
+    """
+    if assembly not in _genomes :
+        try :
+            fname = GENOME_FILES[assembly]
+        except KeyError :
+            raise KeyError ("Unknown genome assembly %s"%assembly)
+        if not os.path.isabs(fname) :
+            fname = '%s/%s'%(os.getenv('HOME'),fname)
+        _genomes[assembly] = Genome.from_file(fname,assembly)
+    return _genomes[assembly]
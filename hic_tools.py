@@ -1,17 +1,496 @@
+import threading
 import numpy as np
-from scipy.stats import entropy
+import scipy.sparse as sp
+from scipy.special import xlogy
+from .hicmatrix import HiCMatrix
+from .hicstore import GenomeContactMatrix, HiCPyramid
+from .utils import chromosome_key, parallel_map
 
-def counts_hic (H,threshold) :
+def _row_blocks (n,block_size) :
+    """
+    Returns the (start, end) bounds of the blocks of 'block_size' rows of a
+    matrix with 'n' rows. If 'block_size' is None, there is a single block.
+    """
+    if block_size is None :
+        block_size = max(n,1)
+    return [(r0,min(r0+block_size,n)) for r0 in range(0,n,block_size)]
+
+def _as_matrix (H) :
+    """
+    Returns the symmetric Hi-C matrix 'H' as a CSR matrix if it is sparse or
+    a HiCMatrix, or as it is if it is dense.
+    """
+    if isinstance(H,HiCMatrix) :
+        return H.tosparse(symmetric=True)
+    if sp.issparse(H) :
+        return H.tocsr()
+    return H
+
+def _row_entropy_terms (X,cols) :
+    """
+    Returns, for each row of X, the sum s of its values in the columns
+    selected by the boolean mask 'cols', and the sum of x*log(x) over the
+    same values.
+    """
+    if sp.issparse(X) :
+        rows = np.repeat(np.arange(X.shape[0]),np.diff(X.indptr))
+        keep = cols[X.indices]
+        x,rows = X.data[keep].astype(float),rows[keep]
+        s = np.bincount(rows,weights=x,minlength=X.shape[0])
+        t = np.bincount(rows,weights=xlogy(x,x),minlength=X.shape[0])
+    else :
+        X = np.asarray(X,dtype=float)[:,cols]
+        s = X.sum(axis=1)
+        t = xlogy(X,X).sum(axis=1)
+    return s,t
+
+def counts_hic (H,threshold,block_size=None,n_workers=None) :
     """
     Given the Hi-C matrix H, calculate the approximate number of contacts that
     the genomic sites make with the others. First, remove the rows that contain
     less than 'threshold' counts, then do the exponential of the entropy.
+    H is either a dense (possibly memory-mapped) matrix, a sparse matrix with
+    both triangles, or a HiCMatrix. The rows are processed in blocks of
+    'block_size' rows (by default, all at once), spread over 'n_workers'
+    threads, so that at most a block of a dense matrix is copied in memory.
+    """
+    H = _as_matrix(H)
+    blocks = _row_blocks(H.shape[0],block_size)
+    row_sums = lambda b : np.asarray(H[b[0]:b[1]].sum(axis=1)).ravel()
+    mask = np.concatenate([np.zeros(0)]+list(parallel_map(row_sums,blocks,
+                                                          n_workers,True)))
+    mask = mask>=threshold
+    def block_terms (b) :
+        rows = np.flatnonzero(mask[b[0]:b[1]]) + b[0]
+        return _row_entropy_terms(H[rows],mask)
+    terms = list(parallel_map(block_terms,blocks,n_workers,True))
+    s = np.concatenate([np.zeros(0)]+[t[0] for t in terms])
+    t = np.concatenate([np.zeros(0)]+[t[1] for t in terms])
+    # entropy of the normalized row: log(s) - sum(x*log(x))/s
+    with np.errstate(divide='ignore',invalid='ignore') :
+        counts = np.exp(np.log(s) - t/s)
+    return counts,mask
+
+def _symmetric_storage (H,upper,blocks) :
+    """
+    Returns the symmetric Hi-C matrix 'H' in a form that can be sliced by
+    rows (a CSR matrix, or a dense matrix), and whether only its upper
+    triangle is stored. If 'upper' is None, this is detected for the sparse
+    matrices, reading them by 'blocks' of rows.
+    """
+    if isinstance(H,HiCMatrix) :
+        return H.matrix,True
+    if isinstance(H,GenomeContactMatrix) :
+        H = H.matrix
+    if not sp.issparse(H) :
+        return H,bool(upper)
+    H = H.tocsr()
+    if upper is None :
+        upper = True
+        for r0,r1 in blocks :
+            X = H[r0:r1]
+            rows = np.repeat(np.arange(r0,r1),np.diff(X.indptr))
+            if (X.indices<rows).any() :
+                upper = False
+                break
+    return H,upper
+
+class _SymmetricMatvec :
+    """
+    The product of the symmetric Hi-C matrix 'H' by a vector, computed with
+    matrix-vector products only. 'H' is a dense (possibly memory-mapped)
+    matrix, a sparse matrix, a HiCMatrix or a GenomeContactMatrix. If
+    'upper' is True, only the upper triangle of 'H' is stored (as in a
+    HiCMatrix, or in the output of 'bam_to_sparse_matrix'): if it is None,
+    this is detected for the sparse matrices. If 'block_size' is given, the
+    rows are read in blocks of 'block_size' rows, spread over 'n_workers'
+    threads, so that only a block of the matrix is in memory at a time.
+    """
+    def __init__ (self,H,upper=None,block_size=None,n_workers=None) :
+        self.blocks = _row_blocks(H.shape[0],block_size)
+        self.H,self.upper = _symmetric_storage(H,upper,self.blocks)
+        self.n = self.H.shape[0]
+        self.n_workers = n_workers
+        if self.upper :
+            self.diagonal = np.asarray(self.H.diagonal(),dtype=float)
+        self.count = 0
+    def __call__ (self,x) :
+        y = np.zeros(self.n)
+        yt = np.zeros(self.n) if self.upper else None
+        lock = threading.Lock()
+        def block_product (b) :
+            X = self.H[b[0]:b[1]]
+            y[b[0]:b[1]] = X.dot(x)
+            if self.upper :
+                t = X.T.dot(x[b[0]:b[1]])
+                with lock :
+                    yt[:] += t
+        list(parallel_map(block_product,self.blocks,self.n_workers,True))
+        self.count += 1
+        if self.upper :
+            y += yt - self.diagonal*x
+        return y
+
+def _balance_mask (matvec,min_counts,mask) :
+    """
+    Returns the mask of the bins that are balanced, and their coverage: the
+    bins whose contacts with the other balanced bins sum to more than zero
+    and to at least 'min_counts', among those of the user 'mask'. Masking a
+    bin lowers the coverage of the others, so that the mask is refined until
+    it does not change.
+    """
+    if mask is None :
+        keep = np.ones(matvec.n,dtype=bool)
+    else :
+        keep = np.array(mask,dtype=bool)
+    while True :
+        coverage = matvec(keep.astype(float))
+        drop = keep & ((coverage<=0) | (coverage<min_counts))
+        if not drop.any() :
+            return keep,coverage
+        keep &= ~drop
+
+def _balance_result (matvec,b,keep,coverage,diagnostics) :
+    """
+    Returns the bias vector that corresponds to the balancing weights 'b',
+    scaled so that the mean coverage of the balanced bins is preserved, and
+    the completed 'diagnostics'.
+    """
+    bias = np.full(matvec.n,np.nan)
+    diagnostics['masked'] = int((~keep).sum())
+    if keep.any() :
+        r = b*matvec(b)
+        c = r[keep].mean()
+        diagnostics['residual'] = float(np.abs(r[keep]/c-1).max())
+        scale = np.sqrt(coverage[keep].mean()/c)
+        bias[keep] = 1./(b[keep]*scale)
+    else :
+        diagnostics['residual'] = np.nan
+    diagnostics['matvecs'] = matvec.count
+    return bias,diagnostics
+
+def ice_balance (H,max_iter=200,tol=1e-5,min_counts=0,mask=None,upper=None,
+                 block_size=None,n_workers=None) :
     """
-    counts = []
-    mask = H.sum(axis=1)>=threshold
-    for row in H[mask] :
-        cleanrow = row[mask]
-        counts.append(np.exp(entropy(cleanrow)))
-    return np.array(counts),mask
+    Balances the symmetric Hi-C matrix 'H' with the iterative correction
+    (ICE) of Imakaev et al., 2012. The bins whose coverage is zero or lower
+    than 'min_counts', or that are not in the boolean 'mask', are excluded.
+    The iterations stop when the row sums of the balanced matrix deviate
+    from their mean by less than 'tol', or after 'max_iter' iterations.
+    Returns the bias vector, as in the KRnorm files of Rao et al. (the
+    balanced matrix is H[i,j]/(bias[i]*bias[j]), and the bias of the
+    excluded bins is NaN), and a dictionary of diagnostics. See
+    '_SymmetricMatvec' for the meaning of 'upper', 'block_size' and
+    'n_workers'.
+    """
+    matvec = _SymmetricMatvec(H,upper,block_size,n_workers)
+    keep,coverage = _balance_mask(matvec,min_counts,mask)
+    b = keep.astype(float)
+    deviations = []
+    for it in range(max_iter if keep.any() else 0) :
+        s = b*matvec(b)
+        s /= s[keep].mean()
+        # symmetric update, that does not oscillate on the bins whose only
+        # contacts are with themselves
+        b[keep] /= np.sqrt(s[keep])
+        deviations.append(float(np.abs(s[keep]-1).max()))
+        if deviations[-1] < tol :
+            break
+    diagnostics = {'method'     : 'ice',
+                   'iterations' : len(deviations),
+                   'converged'  : bool(deviations) and deviations[-1] < tol,
+                   'deviations' : deviations}
+    return _balance_result(matvec,b,keep,coverage,diagnostics)
+
+def kr_balance (H,max_iter=200,tol=1e-6,delta=0.1,Delta=3.,min_counts=0,
+                mask=None,upper=None,block_size=None,n_workers=None) :
+    """
+    Balances the symmetric Hi-C matrix 'H' with the algorithm of Knight and
+    Ruiz, 2013 (the Newton method with conjugate gradient inner iterations,
+    where 'delta' and 'Delta' bound the change of the weights in an inner
+    iteration), as in Rao et al., 2014. The iterations stop when the norm of
+    the residual of the row sums is smaller than 'tol', or after 'max_iter'
+    outer iterations. See 'ice_balance' for the masking of the bins, and for
+    the returned bias vector and diagnostics.
+    """
+    matvec = _SymmetricMatvec(H,upper,block_size,n_workers)
+    keep,coverage = _balance_mask(matvec,min_counts,mask)
+    def A (v) :
+        full = np.zeros(matvec.n)
+        full[keep] = v
+        return matvec(full)[keep]
+    m = int(keep.sum())
+    x = np.ones(m)
+    g, etamax = 0.9, 0.1
+    eta = etamax
+    stop_tol = tol*0.5
+    rt = tol**2
+    v = x*A(x)
+    rk = 1-v
+    rho_km1 = rk.dot(rk)
+    rout = rold = rho_km1
+    residuals = []
+    while m and rout > rt and len(residuals) < max_iter :
+        k = 0
+        y = np.ones(m)
+        innertol = max(eta**2*rout,rt)
+        # inner iterations, by conjugate gradient
+        while rho_km1 > innertol and k < max_iter :
+            k += 1
+            if k == 1 :
+                Z = rk/v
+                p = Z
+                rho_km1 = rk.dot(Z)
+            else :
+                p = Z + rho_km1/rho_km2*p
+            w = x*A(x*p) + v*p
+            alpha = rho_km1/p.dot(w)
+            ap = alpha*p
+            # keep the weights inside the cone [delta,Delta]
+            ynew = y + ap
+            if ynew.min() <= delta :
+                if delta == 0 :
+                    break
+                ind = ap<0
+                y = y + ((delta-y[ind])/ap[ind]).min()*ap
+                break
+            if ynew.max() >= Delta :
+                ind = ynew>Delta
+                y = y + ((Delta-y[ind])/ap[ind]).min()*ap
+                break
+            y = ynew
+            rk = rk - alpha*w
+            rho_km2 = rho_km1
+            Z = rk/v
+            rho_km1 = rk.dot(Z)
+        x = x*y
+        v = x*A(x)
+        rk = 1-v
+        rho_km1 = rk.dot(rk)
+        rout = rho_km1
+        # update of the stopping criterion of the inner iterations
+        rat = rout/rold
+        rold = rout
+        res_norm = np.sqrt(rout)
+        eta_o = eta
+        eta = g*rat
+        if g*eta_o**2 > 0.1 :
+            eta = max(eta,g*eta_o**2)
+        eta = max(min(eta,etamax),stop_tol/res_norm)
+        residuals.append(float(res_norm))
+    b = np.zeros(matvec.n)
+    b[keep] = x
+    diagnostics = {'method'     : 'kr',
+                   'iterations' : len(residuals),
+                   'converged'  : bool(m) and rout <= rt,
+                   'deviations' : residuals}
+    return _balance_result(matvec,b,keep,coverage,diagnostics)
+
+def apply_bias (H,bias) :
+    """
+    Returns the balanced Hi-C matrix H[i,j]/(bias[i]*bias[j]), where 'bias'
+    is returned by 'ice_balance' or 'kr_balance'. 'H' is a dense matrix, a
+    sparse matrix or a HiCMatrix, and the result is of the same kind. The
+    contacts of the bins with NaN bias are NaN in the dense matrices, and are
+    removed from the sparse ones.
+    """
+    if isinstance(H,HiCMatrix) :
+        return HiCMatrix(apply_bias(H.matrix,bias),H.chromosome,H.start,
+                         H.resolution)
+    w = 1./np.asarray(bias,dtype=float)
+    if sp.issparse(H) :
+        X = H.tocoo()
+        val = X.data*w[X.row]*w[X.col]
+        valid = np.isfinite(val)
+        return sp.coo_matrix((val[valid],(X.row[valid],X.col[valid])),
+                             shape=X.shape).tocsr()
+    return np.asarray(H)*w[:,None]*w[None,:]
+
+def _bin_weights (n,mask=None,bias=None) :
+    """
+    Returns the weight of each of the 'n' bins in the observed contacts:
+    1/bias (see 'ice_balance'), or 1, and 0 for the bins that are excluded
+    by the boolean 'mask' or that have NaN bias.
+    """
+    w = np.ones(n)
+    if bias is not None :
+        bias = np.asarray(bias,dtype=float)
+        w = np.where(np.isnan(bias),0.,1./np.where(np.isnan(bias),1.,bias))
+    if mask is not None :
+        w[~np.asarray(mask,dtype=bool)] = 0.
+    return w
 
+def diagonal_sums (H,mask=None,bias=None,upper=None,block_size=None,
+                   n_workers=None) :
+    """
+    Returns the sums of the contacts of the symmetric Hi-C matrix 'H' along
+    each diagonal k = j-i >= 0, and the number of pairs of bins (i,i+k) that
+    are not excluded by the boolean 'mask' or by a NaN 'bias'. If 'bias' is
+    given, the contacts are balanced (see 'apply_bias'). The sums are
+    computed in one pass over the nonzero contacts, by blocks of
+    'block_size' rows, spread over 'n_workers' threads. See
+    '_SymmetricMatvec' for the supported matrices and for 'upper'.
+    """
+    blocks = _row_blocks(H.shape[0],block_size)
+    H,upper = _symmetric_storage(H,upper,blocks)
+    n = H.shape[0]
+    w = _bin_weights(n,mask,bias)
+    def block_sums (b) :
+        X = H[b[0]:b[1]]
+        if sp.issparse(X) :
+            rows = np.repeat(np.arange(b[0],b[1]),np.diff(X.indptr))
+            cols,val = X.indices,X.data
+        else :
+            rows,cols = np.nonzero(np.asarray(X))
+            val = np.asarray(X)[rows,cols]
+            rows = rows + b[0]
+        k = cols-rows
+        upper_part = k>=0
+        val = val[upper_part]*w[rows[upper_part]]*w[cols[upper_part]]
+        return np.bincount(k[upper_part],weights=val,minlength=n)
+    sums = np.zeros(n)
+    for partial in parallel_map(block_sums,blocks,n_workers,True) :
+        sums += partial
+    # number of valid pairs at each distance: autocorrelation of the mask
+    valid = (w>0).astype(float)
+    if valid.all() :
+        counts = np.arange(n,0,-1).astype(float)
+    else :
+        f = np.fft.rfft(valid,2*n)
+        counts = np.rint(np.fft.irfft(f*np.conj(f),2*n)[:n])
+    return sums,counts
 
+def expected_contacts (H,mask=None,bias=None,upper=None,block_size=None,
+                       n_workers=None) :
+    """
+    Returns the expected contacts of the symmetric Hi-C matrix 'H' as a
+    function of the distance k (in bins): the mean of the contacts of each
+    diagonal over its valid pairs of bins (see 'diagonal_sums'). The
+    distances without valid pairs are NaN.
+    """
+    sums,counts = diagonal_sums(H,mask,bias,upper,block_size,n_workers)
+    with np.errstate(divide='ignore',invalid='ignore') :
+        return np.where(counts>0,sums/counts,np.nan)
+
+def oe_block (H,expected,r0,r1,c0,c1,mask=None,bias=None,upper=None) :
+    """
+    Returns the dense block [r0:r1,c0:c1] of the observed/expected matrix of
+    the symmetric Hi-C matrix 'H', where 'expected' is the vector returned by
+    'expected_contacts' (with the same 'mask' and 'bias'). The contacts of
+    the excluded bins are NaN. Only the block is read from 'H'.
+    """
+    H,upper = _symmetric_storage(H,upper,[(0,H.shape[0])])
+    i = np.arange(r0,r1)[:,None]
+    j = np.arange(c0,c1)[None,:]
+    if sp.issparse(H) :
+        O = H[r0:r1,c0:c1].toarray().astype(float)
+        if upper :
+            # the lower triangle, from the transposed block
+            O += np.where(i==j,0.,H[c0:c1,r0:r1].toarray().T)
+    else :
+        O = np.array(H[r0:r1,c0:c1],dtype=float)
+    if bias is not None :
+        bias = np.asarray(bias,dtype=float)
+        O /= bias[r0:r1,None]*bias[None,c0:c1]
+    if mask is not None :
+        mask = np.asarray(mask,dtype=bool)
+        O[~mask[r0:r1],:] = np.nan
+        O[:,~mask[c0:c1]] = np.nan
+    with np.errstate(divide='ignore',invalid='ignore') :
+        return O/np.asarray(expected)[np.abs(j-i)]
+
+def iter_oe_blocks (H,expected,block_size,mask=None,bias=None,
+                    max_distance=None,upper=None) :
+    """
+    Yields the blocks of 'block_size' x 'block_size' bins of the upper
+    triangle of the observed/expected matrix of 'H' (see 'oe_block'), as
+    (r0, c0, block) tuples, one at a time. If 'max_distance' is given (in
+    bins), the blocks that are farther than that from the diagonal are
+    skipped.
+    """
+    H,upper = _symmetric_storage(H,upper,[(0,H.shape[0])])
+    n = H.shape[0]
+    for r0 in range(0,n,block_size) :
+        r1 = min(r0+block_size,n)
+        for c0 in range(r0,n,block_size) :
+            if max_distance is not None and c0-r1+1 > max_distance :
+                break
+            c1 = min(c0+block_size,n)
+            yield r0,c0,oe_block(H,expected,r0,r1,c0,c1,mask,bias,upper)
+
+class ExpectedContacts :
+    """
+    The expected contacts (see 'expected_contacts') of the chromosomes of a
+    Hi-C dataset, computed on the first request for each chromosome and
+    resolution, and then kept. 'source' is either a HiCPyramid or a function
+    source(chromosome,resolution) that returns the chromosome-wide matrix.
+    If 'balance' is 'ice' or 'kr', the matrices are balanced first (see
+    'ice_balance' and 'kr_balance'), and the bias vectors are kept as well.
+    """
+    def __init__ (self,source,balance=None,block_size=None,n_workers=None) :
+        if balance not in (None,'ice','kr') :
+            raise ValueError ("Unsupported balancing method %s"%balance)
+        if isinstance(source,HiCPyramid) :
+            source = source.matrix
+        self.source = source
+        self.balance = balance
+        self.block_size = block_size
+        self.n_workers = n_workers
+        self._expected = {}
+        self._bias = {}
+        # the last matrix that was read from the source
+        self._last = (None,None)
+    def matrix (self,chromosome,resolution) :
+        key = (chromosome_key(chromosome),resolution)
+        if self._last[0] != key :
+            self._last = (key,self.source(chromosome,resolution))
+        return self._last[1]
+    def bias (self,chromosome,resolution) :
+        """
+        Returns the bias vector of the matrix, or None if it is not balanced.
+        """
+        if self.balance is None :
+            return None
+        key = (chromosome_key(chromosome),resolution)
+        if key not in self._bias :
+            balance = ice_balance if self.balance == 'ice' else kr_balance
+            self._bias[key] = balance(self.matrix(chromosome,resolution),
+                                      block_size=self.block_size,
+                                      n_workers=self.n_workers)[0]
+        return self._bias[key]
+    def expected (self,chromosome,resolution) :
+        key = (chromosome_key(chromosome),resolution)
+        if key not in self._expected :
+            self._expected[key] = expected_contacts(
+                self.matrix(chromosome,resolution),
+                bias=self.bias(chromosome,resolution),
+                block_size=self.block_size,n_workers=self.n_workers)
+        return self._expected[key]
+    def oe_block (self,chromosome,resolution,start1,end1,start2=None,
+                  end2=None) :
+        """
+        Returns the observed/expected block between the regions
+        (chromosome, start1, end1) and (chromosome, start2, end2), by default
+        the square block of the first region. The regions are aligned to the
+        bins of the matrix.
+        """
+        if start2 is None :
+            start2,end2 = start1,end1
+        H = self.matrix(chromosome,resolution)
+        n = H.shape[0]
+        bounds = [min(max(x,0),n) for x in (start1//resolution,
+                                             -(-end1//resolution),
+                                             start2//resolution,
+                                             -(-end2//resolution))]
+        return oe_block(H,self.expected(chromosome,resolution),*bounds,
+                        bias=self.bias(chromosome,resolution))
+    def iter_oe_blocks (self,chromosome,resolution,block_size,
+                        max_distance=None) :
+        """
+        Yields the blocks of the observed/expected matrix of the chromosome,
+        see 'iter_oe_blocks'.
+        """
+        return iter_oe_blocks(self.matrix(chromosome,resolution),
+                              self.expected(chromosome,resolution),block_size,
+                              bias=self.bias(chromosome,resolution),
+                              max_distance=max_distance)
@@ -0,0 +1,110 @@
+import numpy as np
+import scipy.sparse as sp
+from .utils import chromosome_mask
+
+class HiCMatrix :
+    """
+    A symmetric Hi-C matrix of the region of a chromosome that starts at
+    'start', at the given 'resolution'. Only the upper triangle of the matrix
+    is stored, as a scipy.sparse CSR matrix, so that chromosome-wide matrices
+    at high resolution fit in memory. The bin 'k' of the matrix corresponds to
+    the genomic interval [start+k*resolution, start+(k+1)*resolution).
+    """
+    def __init__ (self,matrix,chromosome,start,resolution) :
+        self.matrix = sp.triu(matrix,format='csr')
+        self.chromosome = chromosome
+        self.start = start
+        self.resolution = resolution
+    @classmethod
+    def from_csr (cls,matrix,chromosome,start,resolution) :
+        """
+        Builds the matrix from 'matrix', a CSR matrix that already holds only
+        the upper triangle. The matrix is used as is, without a copy, so that
+        it can be backed by memory-mapped arrays.
+        """
+        H = cls.__new__(cls)
+        H.matrix = matrix
+        H.chromosome = chromosome
+        H.start = start
+        H.resolution = resolution
+        return H
+    @classmethod
+    def from_contacts (cls,i,j,val,chromosome,start,end,resolution) :
+        """
+        Builds the matrix of the region [start,end) from the arrays of genomic
+        coordinates 'i' and 'j' of the contacts and their values 'val'. The
+        contacts that fall outside of the region are discarded, and the values
+        of repeated contacts are summed.
+        """
+        N = (end-start)//resolution
+        i = (np.asarray(i)-start)//resolution
+        j = (np.asarray(j)-start)//resolution
+        val = np.asarray(val)
+        inside = (i>=0) & (j>=0) & (i<N) & (j<N)
+        i,j,val = i[inside],j[inside],val[inside]
+        U = sp.coo_matrix((val,(np.minimum(i,j),np.maximum(i,j))),shape=(N,N))
+        return cls(U.tocsr(),chromosome,start,resolution)
+    @classmethod
+    def from_records (cls,data,chromosome,resolution,start=0,end=None) :
+        """
+        Builds the matrix of the region [start,end) of 'chromosome' from the
+        'data' array with fields 'chr', 'i', 'j' and 'val', as returned by
+        'parse_hic'. If 'end' is None, the matrix extends to the last contact
+        of the chromosome.
+        """
+        data = data[chromosome_mask(data['chr'],chromosome)]
+        if end is None :
+            last = max(data['i'].max(),data['j'].max()) if data.size else start
+            end = (last//resolution+1)*resolution
+        return cls.from_contacts(data['i'],data['j'],data['val'],
+                                 chromosome,start,end,resolution)
+    @property
+    def shape (self) :
+        return self.matrix.shape
+    @property
+    def nbytes (self) :
+        """
+        The number of bytes of the arrays of the sparse matrix.
+        """
+        m = self.matrix
+        return m.data.nbytes + m.indices.nbytes + m.indptr.nbytes
+    @property
+    def end (self) :
+        return self.start + self.shape[0]*self.resolution
+    @property
+    def bins (self) :
+        """
+        The genomic coordinates of the start of the bins of the matrix.
+        """
+        return np.arange(self.shape[0])*self.resolution + self.start
+    def region (self,start,end) :
+        """
+        Returns the HiCMatrix of the sub-region [start,end), which must be
+        aligned to the bins of this matrix. The bins that fall outside of this
+        matrix are empty.
+        """
+        N = (end-start)//self.resolution
+        offset = (start-self.start)//self.resolution
+        i0 = min(max(offset,0),self.shape[0])
+        i1 = min(max(offset+N,0),self.shape[0])
+        sub = self.matrix[i0:i1,i0:i1].tocoo()
+        shift = i0-offset
+        U = sp.coo_matrix((sub.data,(sub.row+shift,sub.col+shift)),shape=(N,N),
+                          dtype=self.matrix.dtype)
+        return HiCMatrix(U.tocsr(),self.chromosome,start,self.resolution)
+    def tosparse (self,symmetric=False) :
+        """
+        Returns the upper triangle of the matrix, or the full symmetric matrix
+        if 'symmetric' is True, as a scipy.sparse CSR matrix.
+        """
+        if not symmetric :
+            return self.matrix
+        U = self.matrix
+        return (U + U.T - sp.diags(U.diagonal())).tocsr()
+    def toarray (self) :
+        """
+        Returns the full symmetric matrix as a dense numpy array.
+        """
+        H = self.matrix.toarray()
+        H += np.triu(H,1).T
+        return H
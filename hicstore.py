@@ -0,0 +1,285 @@
+import os
+import json
+import shutil
+import struct
+import numpy as np
+import scipy.sparse as sp
+import pysam
+from .hicmatrix import HiCMatrix
+from .genome import Genome
+from .utils import mkdir_p, chromosome_key
+
+# the file starts with the magic string and the length of the JSON header
+PYRAMID_MAGIC = b'MBTHICP1'
+PYRAMID_RESOLUTIONS = (5000,10000,50000,100000,1000000)
+
+def coarsen_matrix (U,factor) :
+    """
+    Coarsens the upper-triangular sparse matrix 'U' by summing the contacts of
+    blocks of 'factor' x 'factor' bins.
+    """
+    U = U.tocoo()
+    N = (U.shape[0]+factor-1)//factor
+    C = sp.coo_matrix((U.data,(U.row//factor,U.col//factor)),shape=(N,N),
+                      dtype=U.dtype)
+    return C.tocsr()
+
+def _write_array (f,a) :
+    """
+    Writes the array 'a' to the file 'f', aligned to 8 bytes, and returns its
+    offset in the file.
+    """
+    pad = (-f.tell()) % 8
+    f.write(b'\0'*pad)
+    offset = f.tell()
+    f.write(np.ascontiguousarray(a).tobytes())
+    return offset
+
+def build_hic_pyramid (fname,data,resolution,resolutions=None) :
+    """
+    Builds the multi-resolution store 'fname' from the Hi-C 'data' at the
+    finest 'resolution'. The 'data' is either the array returned by
+    'parse_hic', or a dictionary of chromosome-wide HiCMatrix objects. The
+    coarser levels, given by 'resolutions' (by default, the standard ones that
+    are multiples of 'resolution'), are built by coarsening the finest one.
+    All the levels are saved in a single file, where each matrix is stored in
+    CSR format, so that it can be memory-mapped by 'HiCPyramid'.
+    """
+    if resolutions is None :
+        resolutions = [r for r in PYRAMID_RESOLUTIONS if r%resolution==0]
+    resolutions = sorted(set(resolutions) | set([resolution]))
+    for r in resolutions :
+        if r%resolution != 0 :
+            raise ValueError ("Resolution %d is not a multiple of %d"%(r,resolution))
+    if isinstance(data,dict) :
+        chromosomes = list(data.keys())
+    else :
+        chromosomes = [c for c in np.unique(data['chr'])]
+    levels = dict(('%d'%r,{}) for r in resolutions)
+    dtype = None
+    # write the arrays first, and prepend the header once all the offsets are
+    # known
+    tmpname = '%s.%d.tmp'%(fname,os.getpid())
+    with open(tmpname,'wb') as f :
+        for chromosome in chromosomes :
+            if isinstance(data,dict) :
+                H = data[chromosome]
+                if H.start != 0 or H.resolution != resolution :
+                    raise ValueError ("Matrix of %s must start at 0 and have resolution %d"
+                                      %(chromosome,resolution))
+            else :
+                H = HiCMatrix.from_records(data,chromosome,resolution)
+            U = H.matrix
+            dtype = U.dtype
+            for r in resolutions :
+                C = coarsen_matrix(U,r//resolution) if r>resolution else U
+                C.sort_indices()
+                levels['%d'%r][chromosome_key(chromosome)] = {
+                    'nbins'   : C.shape[0],
+                    'nnz'     : int(C.nnz),
+                    'indptr'  : _write_array(f,C.indptr.astype(np.int64)),
+                    'indices' : _write_array(f,C.indices.astype(np.int64)),
+                    'data'    : _write_array(f,C.data)
+                }
+    header = json.dumps({'resolutions' : resolutions,
+                         'dtype'       : np.dtype(dtype).str,
+                         'levels'      : levels}).encode('utf-8')
+    # the offsets are relative to the start of the (aligned) data section
+    data_start = len(PYRAMID_MAGIC) + 8 + len(header)
+    data_start += (-data_start) % 8
+    with open(fname,'wb') as out :
+        out.write(PYRAMID_MAGIC)
+        out.write(struct.pack('<Q',len(header)))
+        out.write(header)
+        out.write(b'\0'*(data_start-out.tell()))
+        with open(tmpname,'rb') as f :
+            shutil.copyfileobj(f,out)
+    os.remove(tmpname)
+    return HiCPyramid(fname)
+
+class HiCPyramid :
+    """
+    A multi-resolution store of Hi-C matrices, as written by
+    'build_hic_pyramid'. The matrices are memory-mapped: a query only reads
+    from disk the rows of the matrix that it needs.
+    """
+    def __init__ (self,fname) :
+        self.fname = fname
+        with open(fname,'rb') as f :
+            if f.read(len(PYRAMID_MAGIC)) != PYRAMID_MAGIC :
+                raise IOError ("%s is not a Hi-C pyramid file"%fname)
+            n = struct.unpack('<Q',f.read(8))[0]
+            header = json.loads(f.read(n).decode('utf-8'))
+        self._data_start = len(PYRAMID_MAGIC) + 8 + n
+        self._data_start += (-self._data_start) % 8
+        self.resolutions = header['resolutions']
+        self.dtype = np.dtype(header['dtype'])
+        self._levels = header['levels']
+        self._arrays = {}
+    def chromosomes (self,resolution=None) :
+        if resolution is None :
+            resolution = self.resolutions[0]
+        return list(self._levels['%d'%resolution].keys())
+    def _csr_arrays (self,chromosome,resolution) :
+        """
+        Returns the memory-mapped indptr, indices and data arrays of the matrix
+        of 'chromosome' at 'resolution'.
+        """
+        key = (chromosome_key(chromosome),resolution)
+        if key not in self._arrays :
+            try :
+                level = self._levels['%d'%resolution][key[0]]
+            except KeyError :
+                raise KeyError ("No data for %s at resolution %d"%key)
+            def mmap (name,dtype,n) :
+                if n == 0 :
+                    return np.zeros(0,dtype=dtype)
+                return np.memmap(self.fname,dtype=dtype,mode='r',
+                                 offset=self._data_start+level[name],shape=(n,))
+            self._arrays[key] = (mmap('indptr',np.int64,level['nbins']+1),
+                                 mmap('indices',np.int64,level['nnz']),
+                                 mmap('data',self.dtype,level['nnz']),
+                                 level['nbins'])
+        return self._arrays[key]
+    def query (self,chromosome,start,end,resolution) :
+        """
+        Returns the HiCMatrix of the region (chromosome, start, end) at the
+        given 'resolution'. The region is aligned to the bins of the matrix.
+        """
+        indptr,indices,data,nbins = self._csr_arrays(chromosome,resolution)
+        i0 = start//resolution
+        i1 = -(-end//resolution)
+        r0,r1 = min(max(i0,0),nbins),min(max(i1,0),nbins)
+        # the rows of the upper triangle contain all the contacts of the region
+        ptr = np.array(indptr[r0:r1+1])
+        rows = sp.csr_matrix((np.array(data[ptr[0]:ptr[-1]]),
+                              np.array(indices[ptr[0]:ptr[-1]]),
+                              ptr-ptr[0]),shape=(r1-r0,nbins))
+        H = HiCMatrix(rows[:,r0:r1],chromosome,r0*resolution,resolution)
+        return H.region(i0*resolution,i1*resolution)
+    def matrix (self,chromosome,resolution) :
+        """
+        Returns the chromosome-wide HiCMatrix of 'chromosome' at 'resolution'.
+        """
+        nbins = self._csr_arrays(chromosome,resolution)[3]
+        return self.query(chromosome,0,nbins*resolution,resolution)
+
+def build_genome_matrix (path,bam,genome,resolution,flag=1807,
+                         chunk_size=1000000,dtype=np.int32) :
+    """
+    Builds the genome-wide contact matrix of the Hi-C 'bam' file at the given
+    'resolution', including the inter-chromosomal blocks, in a single
+    streaming pass over the reads whose flag is not larger than 'flag'. The
+    bins are those of the Genome 'genome'. The matrix is written to the
+    directory 'path' as a memory-mapped .npy file, and is accumulated in
+    chunks of 'chunk_size' reads, so that it is never loaded in memory.
+    Returns the corresponding GenomeContactMatrix.
+    """
+    mkdir_p(path)
+    N = int(genome.bin_offsets(resolution)[-1])
+    M = np.lib.format.open_memmap('%s/matrix.npy'%path,mode='w+',
+                                  dtype=dtype,shape=(N,N))
+    flat = M.reshape(-1)
+    ref = np.empty(chunk_size,dtype=np.int64)
+    pos = np.empty(chunk_size,dtype=np.int64)
+    mref = np.empty(chunk_size,dtype=np.int64)
+    mpos = np.empty(chunk_size,dtype=np.int64)
+    flags = np.empty(chunk_size,dtype=np.int64)
+    with pysam.AlignmentFile(bam,'rb') as samfile :
+        # the reference ids of the bam file, mapped to the chromosomes of the
+        # genome: the last element maps the missing references (-1)
+        refmap = np.array([genome.chromosome_id(r) for r in samfile.references]
+                          + [-1],dtype=np.int64)
+        sizes = genome.sizes
+        def flush (n) :
+            c1 = refmap[ref[:n]]
+            c2 = refmap[mref[:n]]
+            mask = (flags[:n]<=flag) & (c1>=0) & (c2>=0)
+            # discard the positions that fall outside of the chromosomes
+            mask[mask] &= (pos[:n][mask]<=sizes[c1[mask]]) &\
+                          (mpos[:n][mask]<=sizes[c2[mask]])
+            i = genome.to_bins(c1[mask],pos[:n][mask],resolution)
+            j = genome.to_bins(c2[mask],mpos[:n][mask],resolution)
+            # as in 'bam_to_matrix', each read increments both H[i,j] and H[j,i]
+            keys,counts = np.unique(np.r_[i*N+j,j*N+i],return_counts=True)
+            flat[keys] += counts.astype(dtype)
+        n = 0
+        for read in samfile.fetch(until_eof=True) :
+            ref[n] = read.reference_id
+            pos[n] = read.pos
+            mref[n] = read.next_reference_id
+            mpos[n] = read.mpos
+            flags[n] = read.flag
+            n += 1
+            if n == chunk_size :
+                flush(n)
+                n = 0
+        flush(n)
+    M.flush()
+    del flat, M
+    with open('%s/meta.json'%path,'w') as f :
+        json.dump({'assembly'    : genome.assembly,
+                   'resolution'  : resolution,
+                   'chromosomes' : genome.chromosomes,
+                   'sizes'       : genome.sizes.tolist()},f)
+    return GenomeContactMatrix(path)
+
+class GenomeContactMatrix :
+    """
+    A genome-wide contact matrix, with cis and trans blocks, as written by
+    'build_genome_matrix'. The matrix is memory-mapped, so that rows, columns
+    and blocks are read from disk without loading the whole genome.
+    """
+    def __init__ (self,path) :
+        self.path = path
+        with open('%s/meta.json'%path,'r') as f :
+            meta = json.load(f)
+        self.resolution = meta['resolution']
+        self.genome = Genome(meta['chromosomes'],meta['sizes'],meta['assembly'])
+        self.matrix = np.load('%s/matrix.npy'%path,mmap_mode='r')
+    @property
+    def shape (self) :
+        return self.matrix.shape
+    def bin_range (self,chromosome,start=0,end=None) :
+        """
+        Returns the slice of the genome-wide bins of the region
+        (chromosome, start, end). If 'end' is None, the region extends to the
+        end of the chromosome.
+        """
+        c = self.genome.chromosome_id(chromosome)
+        if c < 0 :
+            raise KeyError ("Unknown chromosome %s"%chromosome)
+        offsets = self.genome.bin_offsets(self.resolution)
+        first = offsets[c] + start//self.resolution
+        if end is None :
+            last = offsets[c+1]
+        else :
+            last = min(offsets[c] + -(-end//self.resolution),offsets[c+1])
+        return slice(int(first),int(last))
+    def block (self,chromosome1,chromosome2=None,start1=0,end1=None,
+               start2=0,end2=None) :
+        """
+        Returns the block of contacts between the regions
+        (chromosome1, start1, end1) and (chromosome2, start2, end2). If
+        'chromosome2' is None, returns the cis block of the first region.
+        """
+        rows = self.bin_range(chromosome1,start1,end1)
+        if chromosome2 is None :
+            cols = rows
+        else :
+            cols = self.bin_range(chromosome2,start2,end2)
+        return np.array(self.matrix[rows,cols])
+    def row (self,chromosome,position) :
+        """
+        Returns the genome-wide contacts of the bin that contains the genomic
+        coordinate (chromosome, position).
+        """
+        b = self.bin_range(chromosome,position,position+1).start
+        return np.array(self.matrix[b])
+    def column (self,chromosome,position) :
+        """
+        Returns the column of the bin that contains the genomic coordinate
+        (chromosome, position). The matrix is symmetric, so that the column is
+        read as the corresponding row, which is contiguous on disk.
+        """
+        return self.row(chromosome,position)
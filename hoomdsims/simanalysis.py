@@ -24,8 +24,7 @@ def ps (H) :
     Calculate the normalized probability of contact between a monomer and all
     others as a function of the linear distance s.
     """
-    p = np.array ([np.mean (np.diagonal (H, offset=k))
-                   for k in range (H.shape[0])])
+    p = mbt.expected_contacts (H)
     return p/np.sum(p)
 
 def contacts_with (sim,polymer_text,tracers_text,bindingsites_text,teq,tsample,threshold) :
@@ -0,0 +1,123 @@
+import os
+import re
+import json
+from .parsercache import atomic_write, save_json
+
+# the resolution in the name of the Hi-C files, as in 'res_string'
+_resolution_re = re.compile(r'(\d+[km]b)\.tsv\.gz$')
+
+def file_type (f) :
+    """
+    Returns the type of the data file 'f', from its extension.
+    """
+    if f.endswith('.tsv.gz') :
+        return 'tsv.gz'
+    return f.rsplit('.',1)[-1] if '.' in f else ''
+
+class LocationIndex :
+    """
+    An index of the data files of the sample trees, that are organized as
+    '<base>/samples/<sample_id>/<section>/.../<file>'. Each data root is
+    scanned once, and every file is recorded with its sample id, section,
+    type, resolution and 'with_control' flag. The files of a sample are then
+    found without walking the directories. If 'fname' is given, the index is
+    saved to (and loaded from) that file, and 'refresh' rescans only the
+    directories whose modification time changed.
+    """
+    def __init__ (self,fname=None) :
+        self.fname = fname
+        self.roots = []
+        # directory -> [mtime, files, subdirectories]
+        self._dirs = {}
+        # (base, sample_id) -> list of records
+        self._samples = {}
+        if fname is not None and os.path.exists(fname) :
+            with open(fname,'r') as f :
+                saved = json.load(f)
+            self.roots = saved['roots']
+            self._dirs = saved['dirs']
+            self._build_records()
+    def _walk (self,d,visited) :
+        """
+        Updates the listing of the directory 'd' and of its subdirectories,
+        reusing the listings of the directories that did not change.
+        """
+        try :
+            mtime = os.stat(d).st_mtime
+        except OSError :
+            return
+        entry = self._dirs.get(d)
+        if entry is None or entry[0] != mtime :
+            files, subdirs = [], []
+            for f in sorted(os.listdir(d)) :
+                if os.path.isdir('%s/%s'%(d,f)) :
+                    subdirs.append(f)
+                else :
+                    files.append(f)
+            entry = [mtime,files,subdirs]
+        visited[d] = entry
+        for sub in entry[2] :
+            self._walk('%s/%s'%(d,sub),visited)
+    def _build_records (self) :
+        self._samples = {}
+        for d in sorted(self._dirs.keys()) :
+            parts = d.split('/')
+            if 'samples' not in parts :
+                continue
+            k = len(parts) - 1 - parts[::-1].index('samples')
+            if k+1 >= len(parts) :
+                continue
+            base = '/'.join(parts[:k])
+            sample_id = parts[k+1]
+            section = parts[k+2] if k+2 < len(parts) else ''
+            records = self._samples.setdefault((base,sample_id),[])
+            for f in self._dirs[d][1] :
+                path = '%s/%s'%(d,f)
+                m = _resolution_re.search(f)
+                records.append({'path'         : path,
+                                'name'         : f,
+                                'sample_id'    : sample_id,
+                                'section'      : section,
+                                'type'         : file_type(f),
+                                'resolution'   : m.group(1) if m else None,
+                                'with_control' : 'with_control' in path})
+    def scan (self,root) :
+        """
+        Adds the data root 'root' to the index, and scans it.
+        """
+        root = os.path.normpath(root)
+        if root not in self.roots :
+            self.roots.append(root)
+        self.refresh()
+    def refresh (self) :
+        """
+        Updates the index with the changes in the data roots, rescanning only
+        the directories whose modification time changed, and saves it.
+        """
+        visited = {}
+        for root in self.roots :
+            self._walk(root,visited)
+        self._dirs = visited
+        self._build_records()
+        if self.fname is not None :
+            self.save()
+    def save (self,fname=None) :
+        if fname is None :
+            fname = self.fname
+        atomic_write(fname,{'roots' : self.roots,'dirs' : self._dirs},save_json)
+    def covers (self,path) :
+        """
+        Tells whether 'path' is inside one of the scanned data roots.
+        """
+        path = os.path.normpath(path)
+        return any(path == r or path.startswith(r+'/') for r in self.roots)
+    def files (self,base,sample_id,section=None) :
+        """
+        Returns the records of the files of the sample 'sample_id' under
+        '<base>/samples', optionally restricted to the given 'section' (the
+        first directory under the sample directory).
+        """
+        records = self._samples.get((os.path.normpath(base),sample_id),[])
+        if section is None :
+            return records
+        return [r for r in records if r['section'] == section]
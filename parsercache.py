@@ -0,0 +1,232 @@
+import os
+import glob
+import json
+import pickle
+import hashlib
+import functools
+import numpy as np
+from .utils import mkdir_p, warn_message
+
+# the cache is opt-in: see 'enable_parser_cache'
+_parser_cache = {'enabled'  : False,
+                 'cachedir' : None,
+                 'max_size' : None}
+
+def enable_parser_cache (cachedir=None,max_size=None) :
+    """
+    Enables the binary cache of the text parsers. The parsed arrays are saved
+    in .npy files (and the other parsed objects, as the metadata tables, in
+    .pkl files), either as hidden sidecar files next to the parsed file (if
+    'cachedir' is None) or in the 'cachedir' directory. The cached arrays are
+    keyed on the path, size and modification time of the parsed file, and are
+    memory-mapped on the subsequent calls. If 'max_size' is given, the size in
+    bytes of 'cachedir' is kept below it by evicting the least recently used
+    arrays.
+    """
+    if cachedir is not None :
+        cachedir = os.path.abspath(os.path.expanduser(cachedir))
+        mkdir_p(cachedir)
+    _parser_cache['enabled'] = True
+    _parser_cache['cachedir'] = cachedir
+    _parser_cache['max_size'] = max_size
+
+def disable_parser_cache () :
+    """
+    Disables the binary cache of the text parsers. The cached files are left
+    on disk.
+    """
+    _parser_cache['enabled'] = False
+
+def clear_parser_cache () :
+    """
+    Removes all the cached files from the cache directory.
+    """
+    cachedir = _parser_cache['cachedir']
+    if cachedir is None :
+        return
+    for path in glob.glob('%s/*.npy'%cachedir) + glob.glob('%s/*.pkl'%cachedir) :
+        os.remove(path)
+
+def _cache_key (fname,tag) :
+    """
+    Returns the key that identifies the version of 'fname' on disk, parsed by
+    the parser identified by 'tag'.
+    """
+    st = os.stat(fname)
+    key = '%s:%d:%r:%s'%(os.path.abspath(fname),st.st_size,st.st_mtime,tag)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def cache_path (fname,tag,ext='.npy') :
+    """
+    Returns the path of the cache file for 'fname' as parsed by the parser
+    identified by 'tag'. The sidecar files are named after the parsed file,
+    the parser, a hash of the whole 'tag' and the key of the version of the
+    file (see '_sidecar_prefix').
+    """
+    key = _cache_key(fname,tag)
+    cachedir = _parser_cache['cachedir']
+    if cachedir is None :
+        return '%s%s%s'%(_sidecar_prefix(fname,tag),key[:16],ext)
+    return '%s/%s%s'%(cachedir,key,ext)
+
+def _sidecar_prefix (fname,tag) :
+    """
+    Returns the common prefix of the sidecar files of all the versions of
+    'fname' parsed by the parser identified by 'tag'.
+    """
+    d,base = os.path.split(os.path.abspath(fname))
+    tag_hash = hashlib.sha1(tag.encode('utf-8')).hexdigest()[:8]
+    return '%s/.%s.%s.%s.'%(d,base,tag.split(':')[0],tag_hash)
+
+def _evict (keep) :
+    """
+    Removes the least recently used files of the cache directory until its
+    size falls below the maximum size. The 'keep' file is never removed.
+    """
+    cachedir = _parser_cache['cachedir']
+    max_size = _parser_cache['max_size']
+    if cachedir is None or max_size is None :
+        return
+    entries = []
+    for path in glob.glob('%s/*'%cachedir) :
+        try :
+            st = os.stat(path)
+        except OSError :
+            continue
+        entries.append((st.st_mtime,st.st_size,path))
+    total = sum(e[1] for e in entries)
+    for mtime,size,path in sorted(entries) :
+        if total <= max_size :
+            break
+        if path == keep :
+            continue
+        try :
+            os.remove(path)
+            total -= size
+        except OSError :
+            pass
+
+def _remove_stale (path,fname,tag) :
+    """
+    Removes the sidecar files of the older versions of 'fname' parsed by the
+    parser identified by 'tag': those with the same tag that were written
+    before the last modification of 'fname'.
+    """
+    if _parser_cache['cachedir'] is not None :
+        return
+    prefix = _sidecar_prefix(fname,tag)
+    d,name = os.path.split(prefix)
+    try :
+        mtime = os.stat(fname).st_mtime
+        candidates = os.listdir(d)
+    except OSError :
+        return
+    for f in candidates :
+        stale = '%s/%s'%(d,f)
+        if not f.startswith(name) or stale == path or f.endswith('.tmp') :
+            continue
+        try :
+            if os.stat(stale).st_mtime < mtime :
+                os.remove(stale)
+        except OSError :
+            pass
+
+def save_pickle (f,obj) :
+    pickle.dump(obj,f,pickle.HIGHEST_PROTOCOL)
+
+def save_json (f,obj) :
+    f.write(json.dumps(obj).encode('utf-8'))
+
+def atomic_write (path,obj,save) :
+    """
+    Writes 'obj' to the file 'path' with the function 'save', called as
+    save(f,obj) on a file open in binary mode (as 'np.save', 'save_pickle' or
+    'save_json'). The object is written to a temporary file that is then
+    renamed, so that readers never see a partial file and the mappings of the
+    previous file stay valid.
+    """
+    tmp = '%s.%d.tmp'%(path,os.getpid())
+    try :
+        with open(tmp,'wb') as f :
+            save(f,obj)
+        os.rename(tmp,path)
+    except :
+        if os.path.exists(tmp) :
+            os.remove(tmp)
+        raise
+
+def store_cache (path,obj,save,fname=None,tag=None) :
+    """
+    Stores 'obj' in the cache file 'path' using the function 'save' (see
+    'atomic_write'). If the parsed file 'fname' and the 'tag' of the parser
+    are given, the cache files of its older versions are removed. Returns
+    True if the file was written.
+    """
+    try :
+        atomic_write(path,obj,save)
+    except (IOError,OSError) as e :
+        warn_message('parser_cache','Could not write %s: %s'%(path,e))
+        return False
+    if fname is not None :
+        _remove_stale(path,fname,tag)
+    _evict(path)
+    return True
+
+def touch_cache (path) :
+    """
+    Marks the cache file 'path' as recently used.
+    """
+    try :
+        os.utime(path,None)
+    except OSError :
+        pass
+
+def cached_array (fname,tag,compute) :
+    """
+    Returns the array obtained by calling 'compute()' on the file 'fname'. If
+    the cache is enabled, the array is read from the cache, or stored into it
+    if it was not there yet. Arrays of objects are never cached.
+    """
+    if not _parser_cache['enabled'] :
+        return compute()
+    path = cache_path(fname,tag)
+    if os.path.exists(path) :
+        touch_cache(path)
+        # copy-on-write mapping: the callers may modify the array in memory
+        return np.load(path,mmap_mode='c')
+    a = compute()
+    if isinstance(a,np.ndarray) and not a.dtype.hasobject :
+        store_cache(path,a,np.save,fname,tag)
+    return a
+
+def cached_object (fname,tag,compute) :
+    """
+    Pickle version of 'cached_array', for the objects that are not arrays
+    (as the tables of the metadata spreadsheets). If the cache is enabled,
+    the object returned by 'compute()' is read from the cache, or stored into
+    it if it was not there yet.
+    """
+    if not _parser_cache['enabled'] :
+        return compute()
+    path = cache_path(fname,tag,ext='.pkl')
+    if os.path.exists(path) :
+        try :
+            with open(path,'rb') as f :
+                obj = pickle.load(f)
+            touch_cache(path)
+            return obj
+        except Exception as e :
+            warn_message('parser_cache','Could not read %s: %s'%(path,e))
+    obj = compute()
+    store_cache(path,obj,save_pickle,fname,tag)
+    return obj
+
+def cached_parser (parser) :
+    """
+    Decorator that adds the binary cache to a 'parser(fname,...)' function.
+    """
+    @functools.wraps(parser)
+    def wrapper (fname,*args,**kwargs) :
+        tag = '%s:%r:%r'%(parser.__name__,args,sorted(kwargs.items()))
+        return cached_array(fname,tag,lambda : parser(fname,*args,**kwargs))
+    return wrapper
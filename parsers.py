@@ -2,13 +2,77 @@ import numpy as np
 import os
 import pysam
 import pandas as pd
-import pysam
+import scipy.sparse as sp
+from .parsercache import cached_parser
+from .hicmatrix import HiCMatrix
+from .genome import get_genome
+from .utils import parallel_map
+
+# unmapped, secondary and supplementary alignments
+SAM_SKIP_FLAGS = 0x4 | 0x100 | 0x800
+
+def sam_references (samfilename) :
+    """
+    Returns the array of the reference names of a .sam or .bam file, which can
+    be indexed with the 'chr' ids returned by 'iter_sam'.
+    """
+    with pysam.AlignmentFile(samfilename,"r") as samfile :
+        return np.array(samfile.references)
+
+def iter_sam (samfilename,mapq_threshold=20,chunk_size=1000000,names=False,
+              skip_flags=SAM_SKIP_FLAGS) :
+    """
+    Streams the reads of a .sam or .bam file with mapping quality larger than
+    'mapq_threshold', and whose flag has none of the bits of 'skip_flags'.
+    Yields columnar batches of at most 'chunk_size' reads, as dictionaries of
+    numpy arrays with the keys 'chr' (the reference id, see
+    'sam_references'), 'start', 'end', 'mapq', 'flag' and 'strand' (0 for the
+    forward and 1 for the reverse strand, from the 0x10 bit of the flag). The
+    read names are included in the 'name' key only if 'names' is True.
+    """
+    chrom = np.empty(chunk_size,dtype=np.int32)
+    start = np.empty(chunk_size,dtype=np.int64)
+    end = np.empty(chunk_size,dtype=np.int64)
+    mapq = np.empty(chunk_size,dtype=np.uint8)
+    flag = np.empty(chunk_size,dtype=np.uint16)
+    qnames = []
+    def batch (n) :
+        b = {'chr'    : chrom[:n].copy(),
+             'start'  : start[:n].copy(),
+             'end'    : end[:n].copy(),
+             'mapq'   : mapq[:n].copy(),
+             'flag'   : flag[:n].copy(),
+             'strand' : ((flag[:n] & 0x10) >> 4).astype(np.uint8)}
+        if names :
+            b['name'] = np.array(qnames,dtype='S')
+            del qnames[:]
+        return b
+    n = 0
+    with pysam.AlignmentFile(samfilename,"r") as samfile :
+        for read in samfile.fetch(until_eof=True) :
+            if read.flag & skip_flags or read.mapq <= mapq_threshold :
+                continue
+            chrom[n] = read.reference_id
+            start[n] = read.reference_start
+            # last aligned position, as in read.positions[-1]
+            end[n] = read.reference_end-1
+            mapq[n] = read.mapq
+            flag[n] = read.flag
+            if names :
+                qnames.append(read.qname)
+            n += 1
+            if n == chunk_size :
+                yield batch(n)
+                n = 0
+    if n > 0 :
+        yield batch(n)
 
 def parse_sam (samfilename, mapq_threshold=20) :
     """
     Parses a .sam file and produces an numpy array with the
     'chr', 'start', 'end', 'name', 'mapq', 'strand' fields.
-    For the moment can handle only very simple cases of flags.
+    Unmapped, secondary and supplementary alignments are skipped. For large
+    files, see 'iter_sam'.
     """
     sam_dtype = np.dtype([
                     ('chr','S256'),
@@ -18,25 +82,23 @@ def parse_sam (samfilename, mapq_threshold=20) :
                     ('mapq','i8'),
                     ('strand','S2')
                    ])
-    samfile = pysam.AlignmentFile(samfilename, "r")
-    reads = []
-    for read in samfile.fetch(until_eof=True) :
-        if read.mapq > mapq_threshold :
-            c = samfile.get_reference_name(read.rname)
-            mapq = read.mapq
-            start = read.positions[0]
-            end = read.positions[-1]
-            if read.flag == 0 :
-                strand = '+'
-            elif read.flag == 16 :
-                strand = '-'
-            else :
-                raise ValueError
-            name = read.qname
-            r = (c,start,end,name,mapq,strand)
-            reads.append (r)
-    return np.array (reads, dtype=sam_dtype)
+    references = sam_references(samfilename).astype('S256')
+    strands = np.array(['+','-'],dtype='S2')
+    chunks = []
+    for b in iter_sam(samfilename,mapq_threshold=mapq_threshold,names=True) :
+        reads = np.empty(b['chr'].size,dtype=sam_dtype)
+        reads['chr'] = references[b['chr']]
+        reads['start'] = b['start']
+        reads['end'] = b['end']
+        reads['name'] = b['name']
+        reads['mapq'] = b['mapq']
+        reads['strand'] = strands[b['strand']]
+        chunks.append(reads)
+    if not chunks :
+        return np.array([],dtype=sam_dtype)
+    return np.concatenate(chunks)
 
+@cached_parser
 def parse_broadpeak (fname) :
     """
     Parses a broadpeak file type, and produces a numpy array with the fields of
@@ -55,6 +117,7 @@ def parse_broadpeak (fname) :
                                ])
     return np.genfromtxt (fname,dtype=broadpeak_dtype)
 
+@cached_parser
 def parse_narrowpeak (fname) :
     """
     Parses a broadpeak file type, and produces a numpy array with the fields of
@@ -87,26 +150,23 @@ def res_string (res) :
         s = 'k'
     return '%d%sb'%(m,s)
 
-def chromosome_size (name) :
+def chromosome_size (name,assembly='hg19') :
     """
     Returns the size in base pairs of a given chromosome, according to the
-    genome version h19
+    genome version h19, or to the given 'assembly' (see 'get_genome').
     """
-    fname = '%s/work/data/human/genome_size.dat'%(os.getenv('HOME'))
-    with open (fname,'r') as f :
-        for line in f :
-            curatedline = line.strip('\n').split()
-            if curatedline[0] == '%s'%(name) :
-                return int (curatedline[1])
-    return 0
+    return get_genome(assembly).size(name)
 
 def load_hic_Rao (hic_res,name,normed=True,
-                  Rao_datadir = '/mnt/ant-login/rcortini/work/data/GM12878_replicate/') :
+                  Rao_datadir = '/mnt/ant-login/rcortini/work/data/GM12878_replicate/',
+                  sparse=False,chunksize=None,assembly='hg19') :
     """
     Load the Hi-C matrices from the experiments of Rao et al, 2014, for the
     lymphoblastoid cell line GM12878. User must specify the resolution, the name
     of the chromosome, and whether or not to apply the normalization suggested
-    in the paper
+    in the paper. The contacts are read in bulk, optionally in chunks of
+    'chunksize' lines to bound the memory usage. If 'sparse' is True, the
+    upper triangle of the matrix is returned as a scipy.sparse CSR matrix.
     """
     hic_res_string = res_string (hic_res)
     # build the directory name that contains the data that we want to analyze
@@ -115,28 +175,46 @@ def load_hic_Rao (hic_res,name,normed=True,
                                                             name)
     fname = '%s/%s_%s.RAWobserved'%(d,name,hic_res_string)
     normname = '%s/%s_%s.KRnorm'%(d,name,hic_res_string)
-    if not os.path.exists (fname) or not os.path.exists (fname) :
+    if not os.path.exists (fname) or (normed and not os.path.exists (normname)) :
         raise ValueError('Data for chromosome %s at resolution %d does not exist'
                          %(name,hic_res))
     if normed :
         norm = np.loadtxt (normname)
-    N = chromosome_size(name)/hic_res + 1
-    H = np.zeros ((N,N))
-    with open(fname,'r') as f :
-        for line in f :
-            c = line.strip('\n').split()
-            i = int(c[0])/hic_res
-            j = int(c[1])/hic_res
-            if normed :
-                if np.isnan (norm[i]) or np.isnan (norm[j]) :
-                    M = float(c[2])
-                else :
-                    M = float(c[2])/(norm[i]*norm[j])
-            else :
-                M = float(c[2])
-            H[i,j] = H[j,i] = M
+    N = get_genome(assembly).nbins(name,hic_res)
+    if sparse :
+        rows, cols, vals = [], [], []
+    else :
+        H = np.zeros ((N,N))
+    reader = pd.read_csv(fname,sep=r'\s+',header=None,names=['i','j','val'],
+                         dtype={'i':np.int64,'j':np.int64,'val':np.float64},
+                         chunksize=chunksize)
+    if chunksize is None :
+        reader = [reader]
+    for chunk in reader :
+        i = chunk['i'].values//hic_res
+        j = chunk['j'].values//hic_res
+        M = chunk['val'].values
+        if normed :
+            # the contacts of the bins that have no normalization factor are
+            # left untouched
+            M = M.copy()
+            d = norm[i]*norm[j]
+            valid = ~np.isnan(d)
+            M[valid] /= d[valid]
+        if sparse :
+            rows.append(np.minimum(i,j))
+            cols.append(np.maximum(i,j))
+            vals.append(M)
+        else :
+            H[i,j] = M
+            H[j,i] = M
+    if sparse :
+        return sp.coo_matrix((np.concatenate(vals),
+                              (np.concatenate(rows),np.concatenate(cols))),
+                             shape=(N,N)).tocsr()
     return H
 
+@cached_parser
 def parse_hic (name) :
     """
     Parses a Hi-C file.
@@ -152,6 +230,7 @@ def parse_hic (name) :
                                 'formats':['S12',np.int64,np.int64,np.float64]})
         return np.genfromtxt(name,dtype=hic_dtype)
 
+@cached_parser
 def parse_kallisto_rnaseq (name) :
     """
     Parses an annotated tsv file that was the output of Kallisto.
@@ -165,34 +244,149 @@ def parse_kallisto_rnaseq (name) :
         ])
     return np.genfromtxt(name,dtype=kallisto_dtype,skip_header=1)
 
+def _reduce_contacts (i,j,N) :
+    """
+    Reduces the arrays of bin indices 'i' and 'j' to the unique pairs of the
+    upper triangle of the (N,N) matrix, along with the number of times that
+    each pair was seen. The pairs are returned as linear indices.
+    """
+    lin = np.minimum(i,j)*N + np.maximum(i,j)
+    return np.unique(lin,return_counts=True)
+
+def _stream_contacts (samfile,chromosome,fetch_start,fetch_end,start,end,
+                      resolution,flag,chunk_size) :
+    """
+    Streams the reads of 'samfile' that start in [fetch_start,fetch_end) and
+    whose mate falls in the region [start,end) of the same chromosome. The
+    positions are collected in preallocated chunks of 'chunk_size' reads, and
+    each chunk is binned and reduced in a vectorized way. Returns the linear
+    indices of the upper triangle of the matrix and the corresponding counts.
+    """
+    N = (end-start)//resolution
+    pos = np.empty(chunk_size,dtype=np.int64)
+    mpos = np.empty(chunk_size,dtype=np.int64)
+    flags = np.empty(chunk_size,dtype=np.int64)
+    keys = []
+    vals = []
+    def flush (n) :
+        mask = (flags[:n]<=flag) &\
+               (pos[:n]>=fetch_start) & (pos[:n]<fetch_end) &\
+               (mpos[:n]>=start) & (mpos[:n]<end)
+        i = (pos[:n][mask]-start)//resolution
+        j = (mpos[:n][mask]-start)//resolution
+        inside = (i<N) & (j<N)
+        k,v = _reduce_contacts(i[inside],j[inside],N)
+        keys.append(k)
+        vals.append(v)
+    n = 0
+    for read in samfile.fetch(chromosome,fetch_start,fetch_end) :
+        # mates on other chromosomes can never be in the region
+        if read.next_reference_id != read.reference_id :
+            continue
+        pos[n] = read.pos
+        mpos[n] = read.mpos
+        flags[n] = read.flag
+        n += 1
+        if n == chunk_size :
+            flush(n)
+            n = 0
+    flush(n)
+    # sum the partial counts of all the chunks
+    keys = np.concatenate(keys)
+    vals = np.concatenate(vals)
+    k,inverse = np.unique(keys,return_inverse=True)
+    return k,np.bincount(inverse,weights=vals,minlength=k.size).astype(np.int64)
+
+def bam_to_sparse_matrix (bam,chromosome,start,end,resolution,
+                          flag=1807,chunk_size=1000000) :
+    """
+    Streaming version of 'bam_to_matrix'. The reads of the region
+    (chromosome, start, end) are collected in chunks of 'chunk_size' reads and
+    reduced with vectorized operations, so that the dense matrix is never
+    allocated. Returns the upper triangle of the matrix of counts as a
+    scipy.sparse CSR matrix.
+    """
+    N = (end-start)//resolution
+    with pysam.AlignmentFile(bam,'rb') as samfile :
+        k,v = _stream_contacts(samfile,chromosome,start,end,start,end,
+                               resolution,flag,chunk_size)
+    return sp.coo_matrix((v,(k//N,k%N)),shape=(N,N),dtype=np.int32).tocsr()
+
 def bam_to_matrix(bam,chromosome,start,end,resolution,
-                 flag=1807) :
+                 flag=1807,sparse=False,chunk_size=1000000) :
     """
     Using pysam (that is, samtools), take a bam file and extract the reads of a
     hi-c file corresponding to the given region (chromosome, start, end) and
     having a flag that is less than the given one.
-    Returns a matrix of counts at the given resolution.
+    Returns a matrix of counts at the given resolution. If 'sparse' is True,
+    only the upper triangle of the matrix is returned, as a scipy.sparse CSR
+    matrix, and the dense matrix is never allocated. See
+    'bam_to_sparse_matrix'.
     """
-    # the 'b' flag here indicates that we are dealing with a bam file
+    U = bam_to_sparse_matrix(bam,chromosome,start,end,resolution,
+                             flag=flag,chunk_size=chunk_size)
+    if sparse :
+        return U
+    # each read increments both H[i,j] and H[j,i], so that the diagonal
+    # receives two counts per read
+    return (U + U.T).toarray()
+
+def _bam_tile_contacts (args) :
+    """
+    Worker for 'bam_to_matrices': opens its own handle to the bam file and
+    streams the contacts of a single tile of a region.
+    """
+    n,bam,chromosome,tile_start,tile_end,start,end,resolution,flag,chunk_size = args
     with pysam.AlignmentFile(bam,'rb') as samfile :
-        # init the matrix
-        N = (end-start)/resolution
-        H = np.zeros((N,N),dtype=np.int32)
-        # init the iterator
-        samiter = samfile.fetch(chromosome,start,end)
-        # iterate
-        for read in samiter :
-            if read.flag <= flag :
-                i = read.pos
-                j = read.mpos
-                # we don't check 'i' here: this is already guaranteed by the
-                # invocation to the "fetch" in samtools
-                if j>=start and j<=end :
-                    i_mat = (i-start)/resolution
-                    j_mat = (j-start)/resolution
-                    H[i_mat,j_mat] += 1
-                    H[j_mat,i_mat] += 1
-    return H
+        k,v = _stream_contacts(samfile,chromosome,tile_start,tile_end,start,end,
+                               resolution,flag,chunk_size)
+    return n,k,v
+
+def bam_to_matrices (bam,regions,resolution,flag=1807,tile_size=10000000,
+                     processes=None,chunk_size=1000000) :
+    """
+    Batch version of 'bam_to_sparse_matrix' for indexed bam files. The
+    'regions' are a list of either chromosome names, to extract the whole
+    chromosome, or of (chromosome, start, end) tuples. Each region is split in
+    tiles of 'tile_size' base pairs, and each tile is processed by one of
+    'processes' worker processes, each one with its own pysam handle. The
+    partial matrices of the tiles are then merged. Returns a list with the
+    upper triangle of the matrix of counts of each region, as scipy.sparse CSR
+    matrices, in the same order as 'regions'.
+    """
+    # resolve the whole chromosomes using the header of the bam file
+    with pysam.AlignmentFile(bam,'rb') as samfile :
+        lengths = dict(zip(samfile.references,samfile.lengths))
+    bounds = []
+    for region in regions :
+        if isinstance(region,tuple) :
+            bounds.append(region)
+        else :
+            bounds.append((region,0,(lengths[region]//resolution+1)*resolution))
+    # split the regions in tiles
+    tasks = []
+    for n,(chromosome,start,end) in enumerate(bounds) :
+        for tile_start in range(start,end,tile_size) :
+            tile_end = min(tile_start+tile_size,end)
+            tasks.append((n,bam,chromosome,tile_start,tile_end,start,end,
+                          resolution,flag,chunk_size))
+    keys = [[] for region in bounds]
+    vals = [[] for region in bounds]
+    for n,k,v in parallel_map(_bam_tile_contacts,tasks,processes,ordered=False) :
+        keys[n].append(k)
+        vals[n].append(v)
+    # merge the tiles: the tiles of a region can share a pair (the two mates
+    # of a read pair fall in different tiles, or a bin spans two tiles when
+    # 'tile_size' is not a multiple of 'resolution'), and the counts of the
+    # repeated pairs are summed by the conversion to CSR
+    matrices = []
+    for n,(chromosome,start,end) in enumerate(bounds) :
+        N = (end-start)//resolution
+        k = np.concatenate(keys[n])
+        v = np.concatenate(vals[n])
+        matrices.append(sp.coo_matrix((v,(k//N,k%N)),shape=(N,N),
+                                      dtype=np.int32).tocsr())
+    return matrices
 
 def parse_simple_bed (fname) :
     """
@@ -207,15 +401,14 @@ def parse_simple_bed (fname) :
     return np.genfromtxt (fname,dtype=simple_bed_dtype)
 
 
-def counts_to_hic (counts,start,end,resolution) :
+def counts_to_hic (counts,start,end,resolution,sparse=False) :
     """
     Returns a complete filled matrix given the 'counts' array, by taking
-    for granted that the counts correspond to a given chromosome.
-    """
-    N = (end-start)/resolution + 1
-    H = np.zeros((N,N),dtype=counts['val'].dtype)
-    for h in counts :
-        i = (h['i']-start)/resolution
-        j = (h['j']-start)/resolution
-        H[i,j] = H[j,i] = h['val']
-    return H
+    for granted that the counts correspond to a given chromosome. If 'sparse'
+    is True, returns a HiCMatrix instead of the dense matrix.
+    """
+    H = HiCMatrix.from_contacts(counts['i'],counts['j'],counts['val'],None,
+                                start,end+resolution,resolution)
+    if sparse :
+        return H
+    return H.toarray()
@@ -0,0 +1,102 @@
+import numpy as np
+from .utils import chromosome_key
+
+def aggregate_bins (bins,values,nbins,aggregate='max') :
+    """
+    Aggregates the 'values' that fall into the same element of 'bins', using
+    one of the 'max', 'sum' or 'mean' aggregation functions. Returns an array
+    of 'nbins' elements, in which the empty bins are zero.
+    """
+    if aggregate == 'sum' :
+        return np.bincount(bins,weights=values,minlength=nbins)
+    if aggregate == 'mean' :
+        s = np.bincount(bins,weights=values,minlength=nbins)
+        n = np.bincount(bins,minlength=nbins)
+        return np.divide(s,n,out=np.zeros(nbins),where=n>0)
+    if aggregate == 'max' :
+        y = np.full(nbins,-np.inf)
+        np.maximum.at(y,bins,values)
+        y[np.isinf(y)] = 0.
+        return y
+    raise ValueError ("Unsupported aggregation function %s"%aggregate)
+
+class PeakIndex :
+    """
+    An index of the 'peaks' array of a ChIP-seq track (as returned by
+    'parse_narrowpeak'). For each chromosome, the index keeps the positions of
+    its peaks in the array sorted by start, so that the peaks of a genomic
+    region are found with a binary search.
+    """
+    def __init__ (self,peaks) :
+        peaks = np.atleast_1d(peaks)
+        self.peaks = peaks
+        self._index = {}
+        order = np.lexsort((peaks['start'],peaks['chr']))
+        chrs = peaks['chr'][order]
+        bounds = np.flatnonzero(chrs[1:]!=chrs[:-1])+1
+        for lo,hi in zip(np.r_[0,bounds],np.r_[bounds,chrs.size]) :
+            if lo == hi :
+                continue
+            idx = order[lo:hi]
+            self._index[chromosome_key(chrs[lo])] = (idx,peaks['start'][idx])
+    @property
+    def nbytes (self) :
+        """
+        The number of bytes of the arrays of the index. The peaks array, that
+        is shared with the track, is not counted.
+        """
+        return sum(idx.nbytes+starts.nbytes
+                   for idx,starts in self._index.values())
+    @property
+    def chromosomes (self) :
+        return list(self._index.keys())
+    def query (self,chromosome,start,end) :
+        """
+        Returns the positions in the peaks array of the peaks of 'chromosome'
+        whose start falls in [start,end), sorted by start.
+        """
+        try :
+            idx,starts = self._index[chromosome_key(chromosome)]
+        except KeyError :
+            return np.array([],dtype=np.int64)
+        lo,hi = np.searchsorted(starts,[start,end])
+        return idx[lo:hi]
+    def bin_windows (self,chromosome,starts,length,resolution,field='val',
+                     q_threshold=None,aggregate='max') :
+        """
+        Returns the matrix of the values of the 'field' of the peaks of the
+        windows [start,start+length) of 'chromosome', for each of the
+        'starts', binned at the given 'resolution'. The matrix has one row
+        per window. The peaks with 'q' smaller than 'q_threshold' are
+        excluded, and the values of the peaks that fall in the same bin are
+        aggregated with the 'aggregate' function (see 'aggregate_bins').
+        """
+        starts = np.asarray(starts,dtype=np.int64)
+        nbins = len(range(0,length,resolution))
+        try :
+            idx,peak_starts = self._index[chromosome_key(chromosome)]
+        except KeyError :
+            return np.zeros((starts.size,nbins))
+        if q_threshold is not None :
+            keep = self.peaks['q'][idx]>=q_threshold
+            idx,peak_starts = idx[keep],peak_starts[keep]
+        values = self.peaks[field][idx]
+        # the ranges of peaks of each window, concatenated
+        lo = np.searchsorted(peak_starts,starts)
+        hi = np.searchsorted(peak_starts,starts+length)
+        counts = hi-lo
+        window = np.repeat(np.arange(starts.size),counts)
+        first = np.repeat(lo-np.cumsum(counts)+counts,counts)
+        peak = first + np.arange(window.size)
+        bins = window*nbins + (peak_starts[peak]-starts[window])//resolution
+        y = aggregate_bins(bins,values[peak],starts.size*nbins,aggregate)
+        return y.reshape(starts.size,nbins)
+    def bin_values (self,chromosome,start,end,resolution,field='val',
+                    q_threshold=None,aggregate='max') :
+        """
+        Returns the values of the 'field' of the peaks of the region
+        (chromosome, start, end), binned at the given 'resolution'. See
+        'bin_windows'.
+        """
+        return self.bin_windows(chromosome,[start],end-start,resolution,field,
+                                q_threshold,aggregate)[0]
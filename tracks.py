@@ -0,0 +1,211 @@
+import bisect
+from collections import OrderedDict
+
+class LazyTrack (dict) :
+    """
+    A track of a CellLine that keeps only its metadata in memory. The parsed
+    'data' of the track, and the structures derived from it (as the 'index'
+    of the ChIP-seq tracks), are obtained by calling 'loader()' the first
+    time that they are accessed. If a TrackCache is given, the track
+    registers itself into it, so that its data can be dropped when the
+    memory budget is exceeded, and re-loaded when needed.
+    """
+    lazy_keys = ('data','index')
+    def __init__ (self,metadata,loader,cache=None) :
+        dict.__init__ (self,metadata)
+        self._loader = loader
+        self._cache = cache
+        self._payload = None
+    def __getitem__ (self,key) :
+        if key in self.lazy_keys :
+            return self.load()[key]
+        return dict.__getitem__ (self,key)
+    def __contains__ (self,key) :
+        # every track has its 'data', but the other lazy keys depend on the
+        # loaded payload, as in '__getitem__'
+        if key == 'data' :
+            return True
+        if key in self.lazy_keys :
+            return key in self.load()
+        return dict.__contains__ (self,key)
+    def get (self,key,default=None) :
+        try :
+            return self[key]
+        except KeyError :
+            return default
+    def copy (self) :
+        return LazyTrack (self,self._loader,self._cache)
+    @property
+    def loaded (self) :
+        return self._payload is not None
+    @property
+    def nbytes (self) :
+        """
+        The number of bytes of the loaded data, as reported by the 'nbytes'
+        of its arrays and objects (as a HiCMatrix or a PeakIndex).
+        """
+        if self._payload is None :
+            return 0
+        return sum(getattr(v,'nbytes',0) for v in self._payload.values())
+    def load (self) :
+        """
+        Returns the dictionary of the loaded data, loading it if needed.
+        """
+        if self._payload is None :
+            self._payload = self._loader()
+            if self._cache is not None :
+                self._cache.add (self)
+        elif self._cache is not None :
+            self._cache.touch (self)
+        return self._payload
+    def unload (self) :
+        """
+        Drops the loaded data. It will be loaded again on the next access.
+        """
+        self._payload = None
+
+class TrackCache :
+    """
+    Keeps the total size of the data of the loaded LazyTrack objects below
+    'max_bytes', by unloading the least recently used tracks.
+    """
+    def __init__ (self,max_bytes) :
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._tracks = OrderedDict()
+    def add (self,track) :
+        self._tracks[id(track)] = (track,track.nbytes)
+        self.nbytes += track.nbytes
+        self._evict (track)
+    def touch (self,track) :
+        key = id(track)
+        if key in self._tracks :
+            self._tracks[key] = self._tracks.pop(key)
+    def _evict (self,keep) :
+        for key in list(self._tracks.keys()) :
+            if self.nbytes <= self.max_bytes :
+                break
+            track,nbytes = self._tracks[key]
+            if track is keep :
+                continue
+            del self._tracks[key]
+            track.unload ()
+            self.nbytes -= nbytes
+
+def match_condition (value,condition) :
+    """
+    Tells whether the metadata 'value' satisfies the 'condition', which is
+    either a slice (range condition, start <= value < stop, where a None
+    bound is open), a set, frozenset or list (membership condition), or a
+    value (equality condition).
+    """
+    if isinstance(condition,slice) :
+        try :
+            return (condition.start is None or value >= condition.start) and\
+                   (condition.stop is None or value < condition.stop)
+        except TypeError :
+            return False
+    if isinstance(condition,(set,frozenset,list)) :
+        return any(value == c for c in condition)
+    return value == condition
+
+class TrackCatalog :
+    """
+    The list of the tracks of a CellLine, with an inverted index over their
+    metadata fields that is maintained on insertion. The index answers the
+    equality, membership and range conditions of 'select' without scanning
+    the tracks. The metadata of a track should not be modified after it was
+    added to the catalog.
+    """
+    def __init__ (self) :
+        self.tracks = []
+        # field -> value -> positions of the tracks in the list
+        self._index = {}
+        # fields with unhashable values, that can only be scanned
+        self._unhashable = set()
+        # field -> sorted list of values, for the range conditions
+        self._sorted = {}
+    def __len__ (self) :
+        return len(self.tracks)
+    def __iter__ (self) :
+        return iter(self.tracks)
+    def append (self,track) :
+        n = len(self.tracks)
+        self.tracks.append (track)
+        # dict.items does not trigger the loading of lazy tracks
+        for key,value in dict.items(track) :
+            if key in LazyTrack.lazy_keys :
+                continue
+            try :
+                self._index.setdefault(key,{}).setdefault(value,[]).append(n)
+            except TypeError :
+                self._unhashable.add (key)
+            self._sorted.pop (key,None)
+    def _scan (self,key,condition) :
+        positions = set()
+        for n,track in enumerate(self.tracks) :
+            try :
+                if match_condition (track[key],condition) :
+                    positions.add (n)
+            except KeyError :
+                pass
+        return positions
+    def _sorted_values (self,key) :
+        if key not in self._sorted :
+            try :
+                # the values that are not equal to themselves (NaN, as the
+                # blank cells of the spreadsheets) would break the order
+                self._sorted[key] = sorted(v for v in self._index.get(key,{})
+                                           if v == v)
+            except TypeError :
+                # values that cannot be ordered
+                self._sorted[key] = None
+        return self._sorted[key]
+    def _lookup (self,key,condition) :
+        """
+        Returns the set of positions of the tracks whose field 'key'
+        satisfies 'condition'.
+        """
+        if key in self._unhashable :
+            return self._scan (key,condition)
+        values = self._index.get(key,{})
+        if isinstance(condition,slice) and\
+           condition.start is None and condition.stop is None :
+            selected = list(values)
+        elif isinstance(condition,slice) :
+            ordered = self._sorted_values (key)
+            try :
+                lo = 0 if condition.start is None else\
+                     bisect.bisect_left(ordered,condition.start)
+                hi = len(ordered) if condition.stop is None else\
+                     bisect.bisect_left(ordered,condition.stop)
+                selected = ordered[lo:hi]
+            except TypeError :
+                # values, or bounds, that cannot be ordered
+                selected = [v for v in values if match_condition(v,condition)]
+        elif isinstance(condition,(set,frozenset,list)) :
+            selected = [v for v in condition if v in values]
+        else :
+            try :
+                selected = [condition] if condition in values else []
+            except TypeError :
+                return self._scan (key,condition)
+        positions = set()
+        for v in selected :
+            positions.update (values[v])
+        return positions
+    def select (self,conditions) :
+        """
+        Returns the list of the tracks that satisfy all the 'conditions', a
+        dictionary of metadata fields and conditions (see 'match_condition'),
+        in insertion order.
+        """
+        if not conditions :
+            return list(self.tracks)
+        candidates = None
+        for key,condition in conditions.items() :
+            positions = self._lookup (key,condition)
+            candidates = positions if candidates is None else candidates & positions
+            if not candidates :
+                return []
+        return [self.tracks[n] for n in sorted(candidates)]
@@ -1,5 +1,7 @@
 from __future__ import print_function
 import time, sys, errno, os
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
 def time_string () :
@@ -26,6 +28,29 @@ def consecutive_true(data):
                                      data[:-1] != data[1:],
                                      [True])))[0])[::2]
 
+def chromosome_key(chromosome):
+    """
+    Returns the chromosome name as a string, whether it was given as a string
+    or as bytes.
+    """
+    if isinstance(chromosome, bytes) and not isinstance(chromosome, str):
+        return chromosome.decode('utf-8')
+    return str(chromosome)
+
+def chromosome_mask(chrs, chromosome):
+    """
+    Returns the boolean mask of the elements of the array of chromosome names
+    'chrs' that are equal to 'chromosome', which can be given either as a
+    string or as bytes independently of the dtype of 'chrs'. Only the kind of
+    the name is converted, not its length, so that a longer name is never
+    truncated to the width of 'chrs'.
+    """
+    if chrs.dtype.kind == 'S' and not isinstance(chromosome, bytes):
+        chromosome = chromosome.encode('utf-8')
+    elif chrs.dtype.kind == 'U' and isinstance(chromosome, bytes):
+        chromosome = chromosome.decode('utf-8')
+    return chrs == chromosome
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -35,6 +60,35 @@ def mkdir_p(path):
         else:
             raise
 
+def parallel_map(func, items, processes=None, threads=False, ordered=True):
+    """
+    Returns an iterator over the results of 'func' on each of the 'items',
+    computed by a pool of 'processes' workers (one per CPU if None), that are
+    threads if 'threads' is True and processes otherwise. If 'processes' is 1,
+    or there is at most one item, the items are processed serially. If
+    'ordered' is False, the results are returned as soon as they are ready.
+    The pool is closed when the iterator is exhausted.
+    """
+    items = list(items)
+    if processes == 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+    if threads:
+        pool = ThreadPool(processes)
+    else:
+        pool = multiprocessing.Pool(processes)
+    try:
+        if ordered:
+            results = pool.imap(func, items)
+        else:
+            results = pool.imap_unordered(func, items)
+        for result in results:
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
 def map_seq_to_int(seq) :
     """
     Map a sequence of DNA to an integer
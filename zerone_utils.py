@@ -1,40 +1,35 @@
 import numpy as np
+import pandas as pd
+from .parsercache import cached_parser, cached_array
+from .utils import chromosome_key, parallel_map
 
-def make_zerone_output_index(a,chromosome_list=None) :
-    # if the chromosome names are not given, get them
-    if chromosome_list is None :
-        chromosome_list = np.unique(a['chr'])
-    # init the dictionary and init the iteration
-    c_idx = {}
-    c_start = 0
-    prev_c = a[0]['chr']
-    # we don't sort the input array: Zerone already does this by default
-    for i,b in enumerate(a) :
-        this_c = b['chr']
-        if this_c != prev_c :
-            c_end = i-1
-            c_idx[prev_c] = (c_start,c_end)
-            c_start = i
-            prev_c = this_c
-    # the last chromosome needs to be manually added
-    c_idx[this_c] = (c_start,i)
-    return c_idx
+def _chromosome_runs (chrs) :
+    """
+    Returns the array of the runs of consecutive equal values of the 'chrs'
+    array, with fields 'chr', 'start' and 'end' (inclusive).
+    """
+    bounds = np.flatnonzero(chrs[1:]!=chrs[:-1])+1
+    runs = np.zeros(bounds.size+1 if chrs.size else 0,
+                    dtype=[('chr',chrs.dtype),('start',np.int64),('end',np.int64)])
+    if chrs.size :
+        runs['start'] = np.r_[0,bounds]
+        runs['end'] = np.r_[bounds,chrs.size]-1
+        runs['chr'] = chrs[runs['start']]
+    return runs
+
+def _runs_to_index (runs) :
+    return dict((r['chr'],(int(r['start']),int(r['end']))) for r in runs)
 
-def parse_zerone_output(fname,chromosome_list=None) :
+def make_zerone_output_index(a,chromosome_list=None) :
     """
-    Parses a Zerone output and returns a numpy array. The values of the numpy array
-    are: chromosome, start, end, enrichment, read_1, read_2, ..., read_n, p.
-    The number of `read_i` columns depends on the invocation of Zerone and cannot
-    be known beforehand.
+    Returns the dictionary that maps each chromosome of the `a` array to the
+    (first, last) indices of its rows. The rows of each chromosome are
+    contiguous, as in the Zerone output.
     """
-    # first, we start by reading the first non-comment line in the Zerone file, to
-    # determine the number of `read` columns in the file
-    comment = True
-    with open(fname,'r') as f :
-        for line in f :
-            if not line.startswith('#') :
-                break
-    n_readcols = len(line.split())-6
+    # we don't sort the input array: Zerone already does this by default
+    return _runs_to_index(_chromosome_runs(a['chr']))
+
+def _zerone_dtype (n_readcols) :
     zerone_dtype = [('chr','S256'),
                     ('start',np.int64),
                     ('end',np.int64),
@@ -43,15 +38,54 @@ def parse_zerone_output(fname,chromosome_list=None) :
     for i in range(n_readcols) :
         zerone_dtype.append(('read_%d'%(i),np.int64))
     zerone_dtype.append(('p',float))
-    # now we parse the file using the `genfromtxt` function from numpy
-    a = np.genfromtxt(fname,dtype=np.dtype(zerone_dtype))
-    # next, we exclude the values of the array that pertain to chromosomes that are not
-    # included in the chromosome list that was passed by the user (if any)
+    return np.dtype(zerone_dtype)
+
+@cached_parser
+def _read_zerone (fname,chromosome_list=None,chunk_size=1000000) :
+    """
+    Reads the Zerone output 'fname' in chunks of 'chunk_size' lines, keeping
+    only the rows of the chromosomes in 'chromosome_list' (if given).
+    """
+    # first, we start by reading the first non-comment line in the Zerone file, to
+    # determine the number of `read` columns in the file
+    with open(fname,'r') as f :
+        for line in f :
+            if not line.startswith('#') :
+                break
+    dtype = _zerone_dtype(len(line.split())-6)
     if chromosome_list is not None :
-        a = np.array([s for s in a if s['chr'] in chromosome_list])
-    # now pass the array to the index maker, and return the array along with the index
-    c_idx = make_zerone_output_index(a,chromosome_list)
-    return a,c_idx
+        chromosome_list = [chromosome_key(c) for c in chromosome_list]
+    chunks = []
+    reader = pd.read_csv(fname,sep=r'\s+',comment='#',header=None,
+                         names=dtype.names,chunksize=chunk_size,
+                         dtype=dict((name,str if name=='chr' else dtype[name])
+                                    for name in dtype.names))
+    for df in reader :
+        # exclude the rows of the chromosomes that are not in the list
+        if chromosome_list is not None :
+            df = df[df['chr'].isin(chromosome_list).values]
+        chunk = np.empty(len(df),dtype=dtype)
+        for name in dtype.names :
+            chunk[name] = df[name].values
+        chunks.append(chunk)
+    if not chunks :
+        return np.empty(0,dtype=dtype)
+    return np.concatenate(chunks)
+
+def parse_zerone_output(fname,chromosome_list=None,chunk_size=1000000) :
+    """
+    Parses a Zerone output and returns a numpy array. The values of the numpy array
+    are: chromosome, start, end, enrichment, read_1, read_2, ..., read_n, p.
+    The number of `read_i` columns depends on the invocation of Zerone and cannot
+    be known beforehand. The file is read in chunks of `chunk_size` lines. When
+    the parser cache is enabled (see `enable_parser_cache`), the array and its
+    chromosome index are cached next to the file.
+    """
+    a = _read_zerone(fname,chromosome_list,chunk_size)
+    # the index of the chromosomes, as in `make_zerone_output_index`
+    runs = cached_array(fname,'zerone_index:%r'%(chromosome_list,),
+                        lambda : _chromosome_runs(a['chr']))
+    return a,_runs_to_index(runs)
 
 def find_zerone_peak(a,c_idx,peak,bin_size=300) :
     """
@@ -66,3 +100,70 @@ def find_zerone_peak(a,c_idx,peak,bin_size=300) :
         return [a[c_start+peak_idx_start]]
     else :
         return a[c_start+peak_idx_start:c_start+peak_idx_end+1]
+
+def _zerone_aggregations (names) :
+    """
+    Returns the fields of the Zerone array that are aggregated over the bins
+    of a peak, with the ufunc that aggregates them.
+    """
+    aggregations = [('enrichment',np.maximum),('p',np.minimum),
+                    ('control',np.add)]
+    return aggregations + [(name,np.add) for name in names
+                           if name.startswith('read_')]
+
+def _aggregate_windows (a,lo,hi) :
+    """
+    Aggregates the rows [lo,hi) of the Zerone array `a` for each window (see
+    `find_zerone_peaks`). Only the rows of the windows are read.
+    """
+    aggregations = _zerone_aggregations(a.dtype.names)
+    dtype = [('first',np.int64),('nbins',np.int64)] +\
+            [(name,a.dtype[name]) for name,ufunc in aggregations]
+    out = np.zeros(lo.size,dtype=dtype)
+    counts = hi-lo
+    nonempty = counts>0
+    out['first'] = np.where(nonempty,lo,-1)
+    out['nbins'] = counts
+    out['p'] = np.nan
+    # the rows of all the windows, concatenated
+    offsets = np.cumsum(counts)-counts
+    rows = np.repeat(lo-offsets,counts) + np.arange(counts.sum())
+    if rows.size == 0 :
+        return out
+    for name,ufunc in aggregations :
+        out[name][nonempty] = ufunc.reduceat(a[name][rows],offsets[nonempty])
+    return out
+
+def find_zerone_peaks (a,c_idx,peaks,bin_size=300,n_workers=None,
+                       chunk_size=100000) :
+    """
+    Batch version of `find_zerone_peak`: returns, for each of the `peaks`
+    (an array with the `chr`, `start` and `end` fields, as returned by
+    `parse_narrowpeak`), the aggregated values of the bins of the `a` array
+    that overlap it. The returned array has the fields `first` (the index of
+    the first bin in `a`) and `nbins`, the maximum `enrichment`, the minimum
+    `p`, and the sums of `control` and of the `read_i` columns. The peaks
+    that do not overlap any bin have `nbins` equal to 0. The peaks are
+    processed in chunks of `chunk_size`, spread over `n_workers` threads.
+    """
+    peaks = np.atleast_1d(peaks)
+    index = dict((chromosome_key(c),v) for c,v in c_idx.items())
+    lo = np.zeros(peaks.size,dtype=np.int64)
+    hi = np.zeros(peaks.size,dtype=np.int64)
+    chromosomes,inverse = np.unique(peaks['chr'],return_inverse=True)
+    for k,chromosome in enumerate(chromosomes) :
+        try :
+            c_start,c_end = index[chromosome_key(chromosome)]
+        except KeyError :
+            continue
+        sel = inverse==k
+        lo[sel] = c_start + peaks['start'][sel]//bin_size
+        hi[sel] = np.minimum(c_start + peaks['end'][sel]//bin_size,c_end) + 1
+    hi = np.maximum(hi,lo)
+    bounds = list(range(0,peaks.size,chunk_size)) + [peaks.size]
+    chunks = list(zip(bounds[:-1],bounds[1:]))
+    aggregate = lambda chunk : _aggregate_windows(a,lo[chunk[0]:chunk[1]],
+                                                  hi[chunk[0]:chunk[1]])
+    if len(chunks) <= 1 :
+        return aggregate((0,peaks.size))
+    return np.concatenate(list(parallel_map(aggregate,chunks,n_workers,True)))